@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import BinlogEventSource, ServerMonitor
+from fake_db import MemoryDatabase
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'binlog_events.json')
+
+class RecordedStream:
+    
+    # Записанные события binlog с интерфейсом BinLogStreamReader: события
+    # отдаются по одному, log_file и log_pos сдвигаются вслед за ними. Классы
+    # событий создаются по имени типа - rows_from_event различает их по имени
+    
+    def __init__(self, events: list):
+        self.events = events
+        self.log_file = None
+        self.log_pos = None
+        self.closed = False
+    
+    def __iter__(self):
+        for recorded in self.events:
+            event = type(recorded['type'], (), {})()
+            event.timestamp = recorded['timestamp']
+            event.rows = recorded.get('rows', [])
+            self.log_file = recorded['log_file']
+            self.log_pos = recorded['log_pos']
+            yield event
+    
+    def close(self):
+        self.closed = True
+
+async def replay(fixture: dict) -> list:
+    # Снимок загружается из `table` фикстуры, затем события проходят тот же
+    # путь, что и при чтении binlog: rows_from_event -> apply_change
+    db = MemoryDatabase()
+    for row in fixture['table']:
+        db.store_row(dict(row), log_event=False)
+    monitor = ServerMonitor(db)
+    await monitor.load_snapshot()
+    
+    calls = []
+    
+    async def handle_code_change(user_id, new_data, old_data, changed_at=None):
+        calls.append(['code_change', user_id, old_data.code, new_data.code, changed_at])
+    
+    async def handle_account_binding(user_id, data, changed_at=None):
+        calls.append(['account_binding', user_id, data.owner_id, changed_at])
+    
+    monitor.handle_code_change = handle_code_change
+    monitor.handle_account_binding = handle_account_binding
+    
+    stream = RecordedStream(fixture['events'])
+    source = BinlogEventSource(db.db_config, stream_factory=lambda: stream, server_name=db.server.name)
+    await source.run(monitor.apply_change)
+    
+    expected = fixture['expected']
+    return [
+        ('handler calls', calls, expected['calls']),
+        ('snapshot ids', sorted(monitor.snapshot.ids), expected['snapshot_ids']),
+        ('binlog position', [source.log_file, source.log_pos], expected['position']),
+        ('stream closed', stream.closed, True),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded binlog fixture through BinlogEventSource and ServerMonitor")
+    parser.add_argument('fixture', nargs='?', default=FIXTURE)
+    args = parser.parse_args()
+    
+    with open(args.fixture, encoding='utf-8') as f:
+        fixture = json.load(f)
+    
+    failed = 0
+    for name, actual, expected in asyncio.run(replay(fixture)):
+        if actual == expected:
+            print(f"  {name:<16} ok")
+        else:
+            failed += 1
+            print(f"  {name:<16} FAILED\n    expected {expected}\n    actual   {actual}")
+    
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import asyncio
+import os
+import sys
+import time
+from typing import Any, Dict, Optional, Set
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import DatabaseManager, UserData, USER_FIELDS, WARMUP_CHUNK_SIZE, sql_placeholders
+
+def seed_row(row_id: int, bound_ratio: float) -> Dict[str, Any]:
+    bound = (row_id % 100) < bound_ratio * 100
+    return {
+        'id': row_id,
+        'owner_id': row_id if bound else 0,
+        'tg_id': 5000000000 + row_id,
+        'code': 0,
+        'tg_usname': f"user{row_id}",
+        'player_name': f"Player_{row_id}" if bound else None,
+        'type_name': None,
+    }
+
+class MemoryDatabase(DatabaseManager):
+    
+    # Таблица `telegram` и лента `telegram_events` в памяти процесса. Каждый
+    # запрос ждет latency секунд, чтобы моделировать сетевую задержку MySQL.
+    # Методы game_* изображают запись игрового сервера в таблицу
+    
+    def __init__(self, rows: int = 0, bound_ratio: float = 0.7, latency: float = 0.0,
+                 change_feed: bool = True):
+        super().__init__()
+        self.latency = latency
+        self.change_feed = change_feed
+        self.rows: Dict[int, Dict[str, Any]] = {}
+        self.by_tg_id: Dict[int, int] = {}
+        # event_id - 1 -> (row_id, время изменения)
+        self.events: list = []
+        self.next_id = 1
+        self.queries = 0
+        
+        for row_id in range(1, rows + 1):
+            self.store_row(seed_row(row_id, bound_ratio), log_event=False)
+        self.next_id = rows + 1
+    
+    async def query(self):
+        self.queries += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+    
+    def store_row(self, row: Dict[str, Any], log_event: bool = True):
+        self.rows[row['id']] = row
+        self.by_tg_id[row['tg_id']] = row['id']
+        if log_event:
+            self.events.append((row['id'], time.time()))
+    
+    def drop_row(self, row_id: int):
+        row = self.rows.pop(row_id, None)
+        if row is not None:
+            self.by_tg_id.pop(row['tg_id'], None)
+            self.events.append((row_id, time.time()))
+    
+    async def initialize(self):
+        pass
+    
+    async def close(self):
+        pass
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        return {'queries': self.queries}
+    
+    async def get_user_by_tg_id(self, tg_id: int) -> Optional[UserData]:
+        await self.query()
+        row_id = self.by_tg_id.get(tg_id)
+        return UserData(**self.rows[row_id]) if row_id is not None else None
+    
+    async def upsert_code(self, tg_id: int, code: int, username: str) -> Optional[UserData]:
+        await self.query()
+        row_id = self.by_tg_id.get(tg_id)
+        if row_id is None:
+            row_id = self.next_id
+            self.next_id += 1
+            self.store_row({'id': row_id, 'owner_id': 0, 'tg_id': tg_id, 'code': code, 'tg_usname': username,
+                            'player_name': None, 'type_name': None})
+            return None
+        
+        row = self.rows[row_id]
+        if row['owner_id'] != 0:
+            return UserData(**row)
+        self.store_row(dict(row, code=code, tg_usname=username))
+        return None
+    
+    async def delete_user(self, tg_id: int) -> bool:
+        await self.query()
+        row_id = self.by_tg_id.get(tg_id)
+        if row_id is None:
+            return False
+        self.drop_row(row_id)
+        return True
+    
+    async def update_password(self, player_name: str, new_password: str) -> bool:
+        await self.query()
+        return True
+    
+    async def expire_codes(self, codes: list) -> int:
+        await self.query()
+        updated = 0
+        for row_id, code in codes:
+            row = self.rows.get(row_id)
+            if row is not None and row['code'] == code:
+                self.store_row(dict(row, code=0))
+                updated += 1
+        return updated
+    
+    async def iter_telegram_users(self, shards: Optional[Set[int]] = None, shard_count: int = 1,
+                                  chunk_size: int = WARMUP_CHUNK_SIZE):
+        # Строки копируются по порции за раз, как их отдавал бы серверный курсор
+        row_ids = list(self.rows)
+        for start in range(0, len(row_ids), chunk_size):
+            await self.query()
+            chunk = [dict(self.rows[row_id]) for row_id in row_ids[start:start + chunk_size]
+                     if row_id in self.rows and (shards is None or row_id % shard_count in shards)]
+            if chunk:
+                yield chunk
+    
+    async def get_binlog_position(self):
+        return None
+    
+    async def has_change_feed(self) -> bool:
+        await self.query()
+        return self.change_feed
+    
+    async def get_feed_watermark(self) -> int:
+        await self.query()
+        return len(self.events)
+    
+    async def get_telegram_changes(self, after_event_id: int, limit: int = 1000,
+                                   shards: Optional[Set[int]] = None, shard_count: int = 1) -> list:
+        await self.query()
+        changes = []
+        for offset, (row_id, changed_at) in enumerate(self.events[after_event_id:after_event_id + limit]):
+            if shards is not None and row_id % shard_count not in shards:
+                continue
+            row = self.rows.get(row_id) or dict.fromkeys(USER_FIELDS)
+            changes.append(dict(row, event_id=after_event_id + offset + 1, row_id=row_id, changed_at=changed_at))
+        return changes
+    
+    async def prune_telegram_events(self, retention_hours: int = 24) -> int:
+        return 0
+    
+    async def bound_row_ids(self) -> list:
+        return [row_id for row_id, row in self.rows.items() if row['owner_id'] != 0]
+    
+    async def game_set_codes(self, codes: Dict[int, int]) -> float:
+        for row_id, code in codes.items():
+            self.store_row(dict(self.rows[row_id], code=code, type_name="Смена пароля"))
+        return time.time()
+
+class MySQLFixture:
+    
+    # Тот же интерфейс поверх настоящего MySQL: таблица `telegram` в отдельной
+    # базе пересоздается и заполняется rows строками. Никогда не указывайте
+    # рабочую базу - таблица очищается
+    
+    TELEGRAM_DDL = """CREATE TABLE IF NOT EXISTS telegram (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        owner_id INT NOT NULL DEFAULT 0,
+        tg_id BIGINT NOT NULL,
+        code INT NOT NULL DEFAULT 0,
+        tg_usname VARCHAR(64) DEFAULT NULL,
+        player_name VARCHAR(64) DEFAULT NULL,
+        type_name VARCHAR(64) DEFAULT NULL
+    )"""
+    ACCOUNTS_DDL = """CREATE TABLE IF NOT EXISTS accounts_1101 (
+        name VARCHAR(64) NOT NULL PRIMARY KEY,
+        players_password VARCHAR(64) NOT NULL DEFAULT ''
+    )"""
+    SEED_BATCH = 5000
+    
+    def __init__(self, dsn: str):
+        # user:password@host:port/database
+        credentials, _, location = dsn.rpartition('@')
+        user, _, password = credentials.partition(':')
+        address, _, database = location.partition('/')
+        host, _, port = address.partition(':')
+        
+        self.db = DatabaseManager()
+        self.db.db_config.update(host=host, port=int(port or 3306), user=user, password=password, db=database)
+    
+    async def setup(self, rows: int, bound_ratio: float = 0.7, change_feed: bool = True):
+        db = self.db
+        await db.initialize()
+        for statement in ("DROP TABLE IF EXISTS telegram_events", "DROP TABLE IF EXISTS telegram",
+                          self.TELEGRAM_DDL, self.ACCOUNTS_DDL):
+            await db.execute_update(statement)
+        
+        for start in range(1, rows + 1, self.SEED_BATCH):
+            batch = [seed_row(row_id, bound_ratio) for row_id in range(start, min(start + self.SEED_BATCH, rows + 1))]
+            await db.execute_update(
+                f"INSERT INTO telegram ({', '.join(USER_FIELDS)}) VALUES "
+                f"{sql_placeholders(len(batch), '(' + sql_placeholders(len(USER_FIELDS)) + ')')}",
+                tuple(row[name] for row in batch for name in USER_FIELDS)
+            )
+        
+        # Индекс создается той же миграцией, что и BOT_MIGRATE_SCHEMA на рабочей базе
+        await db.create_unique_tg_id()
+        if change_feed:
+            await db.create_change_feed()
+    
+    async def close(self):
+        await self.db.close()
+    
+    async def bound_row_ids(self) -> list:
+        result = await self.db.execute_query("SELECT id FROM telegram WHERE owner_id != 0")
+        return [row['id'] for row in result]
+    
+    async def game_set_codes(self, codes: Dict[int, int]) -> float:
+        ids = list(codes)
+        cases = sql_placeholders(len(ids), "WHEN %s THEN %s", " ")
+        await self.db.execute_update(
+            f"UPDATE telegram SET code = CASE id {cases} END, type_name = 'Смена пароля' "
+            f"WHERE id IN ({sql_placeholders(len(ids))})",
+            tuple(value for row_id in ids for value in (row_id, codes[row_id])) + tuple(ids)
+        )
+        return time.time()
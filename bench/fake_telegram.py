@@ -0,0 +1,139 @@
+import asyncio
+import json
+import random
+import socket
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from aiohttp import ClientSession, web
+from telebot import asyncio_helper
+
+@dataclass
+class ApiCall:
+    method: str
+    chat_id: Optional[int]
+    received_at: float
+    ok: bool
+
+class FakeBotApi:
+    
+    # Локальный Bot API: отвечает на вызовы бота правдоподобными объектами,
+    # записывает их и по настройке задерживает ответы или возвращает 429
+    
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit_ratio: float = 0.0,
+                 retry_after: int = 1, host: str = '127.0.0.1', port: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.host = host
+        self.port = port
+        self.calls: list = []
+        self.message_id = 0
+        self.rate_limited = 0
+        self.runner = None
+        self.previous_api_url = None
+    
+    async def start(self):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((self.host, self.port))
+        self.port = sock.getsockname()[1]
+        await web.SockSite(self.runner, sock).start()
+        
+        self.previous_api_url = asyncio_helper.API_URL
+        asyncio_helper.API_URL = f"http://{self.host}:{self.port}/bot{{0}}/{{1}}"
+    
+    async def stop(self):
+        asyncio_helper.API_URL = self.previous_api_url
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+    
+    async def read_params(self, request) -> dict:
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = dict(request.query)
+        params.update(await request.post())
+        return params
+    
+    def message(self, chat_id: Optional[int], text: str = '') -> dict:
+        self.message_id += 1
+        return {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id or 0, 'type': 'private'},
+            'text': text,
+        }
+    
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = await self.read_params(request)
+        chat_id = int(params['chat_id']) if params.get('chat_id') else None
+        
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        
+        if method.startswith(('sendMessage', 'editMessage')) and random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            self.calls.append(ApiCall(method, chat_id, time.time(), False))
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            })
+        
+        self.calls.append(ApiCall(method, chat_id, time.time(), True))
+        
+        if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            result = self.message(chat_id, params.get('text', ''))
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif method == 'getUpdates':
+            result = []
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+    
+    def sent(self, method: str = 'sendMessage') -> list:
+        return [call for call in self.calls if call.method == method and call.ok]
+    
+    def summary(self) -> str:
+        counts = {}
+        for call in self.calls:
+            counts[call.method] = counts.get(call.method, 0) + 1
+        return json.dumps({'calls': counts, 'rate_limited': self.rate_limited})
+
+class WebhookClient:
+    
+    # Сторона Telegram в режиме webhook: доставляет обновления POST-запросами на
+    # адрес бота с заголовком секретного токена и возвращает код ответа бота
+    
+    def __init__(self, url: str, secret_token: str):
+        self.url = url
+        self.secret_token = secret_token
+        self.session = None
+    
+    async def start(self):
+        self.session = ClientSession()
+    
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+    
+    async def deliver(self, body, secret_token: Optional[str] = None) -> int:
+        # body - объект обновления или готовая строка (для проверки некорректных тел)
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Telegram-Bot-Api-Secret-Token': self.secret_token if secret_token is None else secret_token,
+        }
+        data = body if isinstance(body, str) else json.dumps(body)
+        async with self.session.post(self.url, data=data, headers=headers) as response:
+            return response.status
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot import types
+
+import main
+from main import CodeManager, MemoryStateStore, ServerMonitor, TelegramBot, Throttle, THROTTLE_LIMITS, THROTTLE_REJECTED
+from fake_db import MemoryDatabase, MySQLFixture
+from fake_telegram import FakeBotApi
+
+TOKEN = '123456:BENCH'
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] if ordered else 0.0
+
+def report(name: str, samples: list, elapsed: float):
+    if not samples:
+        print(f"  {name:<28} no samples")
+        return
+    print(f"  {name:<28} n={len(samples):<7} {len(samples) / elapsed:9.1f}/s  "
+          f"p50={percentile(samples, 0.5) * 1000:8.2f} ms  p99={percentile(samples, 0.99) * 1000:8.2f} ms  "
+          f"max={max(samples) * 1000:8.2f} ms")
+
+def record_calls(obj, name: str, samples: list):
+    original = getattr(obj, name)
+    
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await original(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - started)
+    
+    setattr(obj, name, wrapper)
+
+def record_expiry(monitor: ServerMonitor, lags: list, passes: list):
+    # Задержка обнуления: сколько код прожил сверх своего срока
+    original = monitor.expire_codes
+    
+    async def expire_codes(code_ids: list):
+        now = time.monotonic()
+        lags.extend(now - monitor.codes.active_codes[code_id].expires_at
+                    for code_id in code_ids if code_id in monitor.codes.active_codes)
+        started = time.perf_counter()
+        try:
+            await original(code_ids)
+        finally:
+            passes.append(time.perf_counter() - started)
+    
+    monitor.expire_codes = expire_codes
+
+def make_user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}", 'username': f"user{user_id}"}
+
+def make_message(update_id: int, user_id: int, text: str) -> types.Update:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': make_user(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return types.Update.de_json({'update_id': update_id, 'message': message})
+
+def make_callback(update_id: int, user_id: int, data: str) -> types.Update:
+    return types.Update.de_json({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': make_user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'bench',
+            },
+        },
+    })
+
+class Harness:
+    
+    def __init__(self, args):
+        self.args = args
+        self.api = FakeBotApi(args.api_latency, args.api_jitter, args.rate_limit_ratio)
+        self.fixture = None
+        self.db = None
+        self.monitor = None
+        self.bot = None
+        self.update_id = 0
+        self.samples: Dict[str, list] = {}
+    
+    async def start(self):
+        args = self.args
+        await self.api.start()
+        
+        if args.mysql:
+            self.fixture = MySQLFixture(args.mysql)
+            await self.fixture.setup(args.rows, args.bound_ratio, not args.full_scan)
+            self.db = self.fixture.db
+        else:
+            self.fixture = self.db = MemoryDatabase(args.rows, args.bound_ratio, args.db_latency, not args.full_scan)
+        
+        main.MONITOR_INTERVAL = args.monitor_interval
+        # Рассылки не входят в сценарии, а у MemoryDatabase нет их таблиц
+        main.ADMIN_IDS = set()
+        store = MemoryStateStore()
+        codes = CodeManager(store, f"code:{self.db.server.name}")
+        # Срок жизни кода укорачивается, чтобы сценарий дождался обнуления
+        code_ttl = args.code_ttl / 60
+        codes.add_code = lambda code_id, tg_id, code, expiry_minutes=1: CodeManager.add_code(
+            codes, code_id, tg_id, code, code_ttl)
+        self.monitor = monitor = ServerMonitor(self.db, codes)
+        self.bot = bot = TelegramBot(TOKEN, [monitor], CodeManager(store))
+        if not args.throttle:
+            # Сценарии меряют обработчики, а не отказы: лимиты снимаются
+            unlimited = float('inf')
+            bot.throttle = Throttle({action: (unlimited, unlimited) for action in THROTTLE_LIMITS},
+                                    global_rate=unlimited, global_burst=unlimited)
+        
+        for name in ('poll_change_feed', 'poll_full_table'):
+            record_calls(monitor, name, self.samples.setdefault('monitor_telegram_table', []))
+        record_calls(bot, 'process_code_request', self.samples.setdefault('process_code_request', []))
+        record_expiry(monitor, self.samples.setdefault('expiry_lag', []),
+                      self.samples.setdefault('check_expired_codes', []))
+        
+        started = time.perf_counter()
+        await bot.start_monitoring()
+        await monitor.warmed_up.wait()
+        print(f"warm-up: {len(monitor.snapshot)} rows in {time.perf_counter() - started:.2f} s")
+        bot.dispatcher.start()
+    
+    async def stop(self):
+        current = asyncio.current_task()
+        tasks = [task for task in asyncio.all_tasks() if task is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.bot.bot.close_session()
+        await self.api.stop()
+        if isinstance(self.fixture, MySQLFixture):
+            await self.fixture.close()
+    
+    def reset_samples(self):
+        for samples in self.samples.values():
+            samples.clear()
+        self.api.calls.clear()
+    
+    async def submit(self, updates: list):
+        for update in updates:
+            await self.bot.dispatcher.submit(update)
+        await asyncio.gather(*(lane.join() for lane in self.bot.dispatcher.lanes))
+    
+    def report_throttle(self, rejected_before: dict):
+        rejected = {key: value - rejected_before.get(key, 0) for key, value in THROTTLE_REJECTED.values.items()}
+        summary = ', '.join(f"{dict(key)['action']}/{dict(key)['scope']}={int(value)}"
+                            for key, value in sorted(rejected.items()) if value)
+        print(f"  {'throttle rejected':<28} {summary or 'none'}")
+    
+    def next_update_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+    
+    async def wait_for(self, condition, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.01)
+        return True
+    
+    async def burst_code_changes(self):
+        # Игровой сервер одновременно выдает коды count привязанным аккаунтам:
+        # монитор должен заметить их, разослать уведомления и обнулить по сроку
+        bound = await self.fixture.bound_row_ids()
+        row_ids = random.sample(bound, min(self.args.count, len(bound)))
+        tg_ids = {5000000000 + row_id for row_id in row_ids}
+        self.reset_samples()
+        
+        started = time.perf_counter()
+        changed_at = await self.fixture.game_set_codes({row_id: random.randint(100000, 999999) for row_id in row_ids})
+        delivered = await self.wait_for(lambda: len({call.chat_id for call in self.api.sent()} & tg_ids) >= len(tg_ids),
+                                        self.args.timeout)
+        elapsed = time.perf_counter() - started
+        
+        first_sent = {}
+        for call in self.api.sent():
+            if call.chat_id in tg_ids:
+                first_sent.setdefault(call.chat_id, call.received_at)
+        delivery = [received_at - changed_at for received_at in first_sent.values()]
+        
+        await self.wait_for(lambda: not self.monitor.codes.active_codes, self.args.code_ttl + self.args.timeout)
+        
+        print(f"burst_code_changes: {len(row_ids)} codes, delivered={len(first_sent)}"
+              f"{'' if delivered else ' (timeout)'}, api={self.api.summary()}")
+        report('code delivery', delivery, elapsed)
+        report('monitor_telegram_table', self.samples['monitor_telegram_table'], elapsed)
+        report('check_expired_codes', self.samples['check_expired_codes'], elapsed)
+        report('expiry lag', self.samples['expiry_lag'], elapsed)
+    
+    async def mass_addcode(self):
+        # count новых пользователей одновременно отправляют /addcode, каждый
+        # пятый дважды (повторное нажатие)
+        self.reset_samples()
+        first_user = 7000000000 + self.update_id
+        updates = []
+        for user_id in range(first_user, first_user + self.args.count):
+            updates.append(make_message(self.next_update_id(), user_id, '/addcode'))
+            if user_id % 5 == 0:
+                updates.append(make_message(self.next_update_id(), user_id, '/addcode'))
+        
+        started = time.perf_counter()
+        await self.submit(updates)
+        elapsed = time.perf_counter() - started
+        
+        print(f"mass_addcode: {self.args.count} users, {len(updates)} updates, api={self.api.summary()}")
+        report('process_code_request', self.samples['process_code_request'], elapsed)
+    
+    async def captcha_storm(self):
+        # Привязанные пользователи начинают отвязку, ошибаются в капче, затем
+        # отвечают верно - отвязка удаляет строку из `telegram`
+        bound = await self.fixture.bound_row_ids()
+        user_ids = [5000000000 + row_id for row_id in random.sample(bound, min(self.args.count, len(bound)))]
+        self.reset_samples()
+        handler_samples: Dict[str, list] = {}
+        original = self.bot.run_timed
+        
+        async def run_timed(label: str, handler, *args):
+            started = time.perf_counter()
+            try:
+                await original(label, handler, *args)
+            finally:
+                handler_samples.setdefault(label, []).append(time.perf_counter() - started)
+        
+        self.bot.run_timed = run_timed
+        started = time.perf_counter()
+        try:
+            await self.submit([make_callback(self.next_update_id(), user_id, 'deltg') for user_id in user_ids])
+            
+            answers = []
+            for user_id in user_ids:
+                captcha = await self.bot.codes.store.get('captcha', user_id)
+                if captcha is None:
+                    continue
+                answers.append(make_message(self.next_update_id(), user_id, 'wrong'))
+                answers.append(make_message(self.next_update_id(), user_id, captcha['answer']))
+            await self.submit(answers)
+        finally:
+            self.bot.run_timed = original
+        elapsed = time.perf_counter() - started
+        
+        print(f"captcha_storm: {len(user_ids)} users, api={self.api.summary()}")
+        for label, samples in sorted(handler_samples.items()):
+            report(label, samples, elapsed)
+
+SCENARIOS = {
+    'burst': Harness.burst_code_changes,
+    'addcode': Harness.mass_addcode,
+    'captcha': Harness.captcha_storm,
+}
+
+async def run(args):
+    harness = Harness(args)
+    await harness.start()
+    try:
+        for name in args.scenarios:
+            rejected_before = dict(THROTTLE_REJECTED.values)
+            await SCENARIOS[name](harness)
+            harness.report_throttle(rejected_before)
+    finally:
+        await harness.stop()
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Load test of main.py against a fake Bot API and MySQL stand-in")
+    parser.add_argument('scenarios', nargs='*', help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--rows', type=int, default=100000, help="rows seeded into `telegram`")
+    parser.add_argument('--count', type=int, default=500, help="codes, users or captchas per scenario")
+    parser.add_argument('--bound-ratio', type=float, default=0.7)
+    parser.add_argument('--mysql', help="user:password@host:port/database of a disposable MySQL schema")
+    parser.add_argument('--full-scan', action='store_true', help="monitor without the `telegram_events` feed")
+    parser.add_argument('--db-latency', type=float, default=0.001, help="seconds per query of the in-memory stand-in")
+    parser.add_argument('--api-latency', type=float, default=0.02)
+    parser.add_argument('--api-jitter', type=float, default=0.02)
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help="share of sends answered with 429")
+    parser.add_argument('--monitor-interval', type=float, default=0.5)
+    parser.add_argument('--code-ttl', type=float, default=2.0, help="code lifetime in seconds")
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--throttle', action='store_true',
+                        help="keep the bot's per-user and global throttle limits (lifted by default)")
+    args = parser.parse_args()
+    
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    
+    random.seed(42)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,97 @@
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import TelegramSnapshot
+
+@dataclass
+class LegacyUserData:
+    id: int
+    owner_id: int
+    tg_id: int
+    code: int
+    tg_usname: str
+    player_name: Optional[str]
+    type_name: Optional[str]
+
+def make_rows(count: int, changed: int = 0) -> list:
+    return [
+        {
+            'id': i,
+            'owner_id': i if i % 3 else 0,
+            'tg_id': 5000000000 + i,
+            'code': 100000 + i % 900000 if i < changed else 0,
+            'tg_usname': f"user{i}",
+            'player_name': f"Player_{i}",
+            'type_name': None,
+        }
+        for i in range(count)
+    ]
+
+def measure(func, *args):
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak
+
+def timed(func, *args) -> float:
+    gc.collect()
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+def legacy_build(rows):
+    return {row['id']: LegacyUserData(**row) for row in rows}
+
+def legacy_tick(last_user_data, rows):
+    current_users = {row['id']: LegacyUserData(**row) for row in rows}
+    changed = [user_id for user_id, data in current_users.items()
+               if user_id in last_user_data and last_user_data[user_id].code != data.code]
+    return current_users.copy(), changed
+
+def snapshot_build(rows):
+    snapshot = TelegramSnapshot()
+    for row in rows:
+        snapshot.apply_row(row)
+    return snapshot
+
+def report(count: int, changed: int):
+    rows = make_rows(count)
+    fresh_rows = make_rows(count, changed)
+    
+    legacy, legacy_size, _ = measure(legacy_build, rows)
+    _, _, legacy_peak = measure(legacy_tick, legacy, fresh_rows)
+    legacy_time = timed(legacy_tick, legacy, fresh_rows)
+    del legacy
+    
+    snapshot, snapshot_size, _ = measure(snapshot_build, rows)
+    (changes, removed), _, snapshot_peak = measure(snapshot.sync, fresh_rows)
+    assert len(changes) == changed and not removed
+    snapshot_time = timed(snapshot_build(rows).sync, fresh_rows)
+    
+    print(f"rows={count} changed_per_tick={changed}")
+    print(f"  dict[UserData]:   {legacy_size / count:7.1f} B/row resident, "
+          f"{legacy_peak / 2 ** 20:8.1f} MiB allocated per tick, {legacy_time * 1000:8.1f} ms per tick")
+    print(f"  TelegramSnapshot: {snapshot_size / count:7.1f} B/row resident, "
+          f"{snapshot_peak / 2 ** 20:8.1f} MiB allocated per tick, {snapshot_time * 1000:8.1f} ms per tick")
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory footprint of the telegram table snapshot")
+    parser.add_argument('sizes', nargs='*', type=int, default=[100000, 1000000])
+    parser.add_argument('--changed', type=int, default=100)
+    args = parser.parse_args()
+    
+    for count in args.sizes:
+        report(count, args.changed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import CodeManager, DISPATCH_LANES, MemoryStateStore, ServerMonitor, TelegramBot
+from fake_db import MemoryDatabase
+from fake_telegram import FakeBotApi, WebhookClient
+
+TOKEN = '123456:BENCH'
+WEBHOOK_URL = 'https://bot.example/telegram'
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_update(update_id: int, user_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+            'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+async def check(users: int, flood: int) -> list:
+    # Бот в режиме webhook: обновления приходят POST-запросами от WebhookClient,
+    # ответы обработчиков уходят в локальный Bot API (с задержкой, чтобы
+    # обновления успевали накопиться в полосах)
+    api = FakeBotApi(latency=0.05)
+    await api.start()
+    bot = TelegramBot(TOKEN, [ServerMonitor(MemoryDatabase())], CodeManager(MemoryStateStore()), update_mode='webhook')
+    webhook = bot.webhook
+    webhook.host, webhook.port, webhook.url = '127.0.0.1', free_port(), WEBHOOK_URL
+    client = WebhookClient(f"http://{webhook.host}:{webhook.port}{webhook.path}", webhook.secret_token)
+    
+    await webhook.start()
+    bot.dispatcher.start()
+    await client.start()
+    try:
+        user_ids = list(range(6000000000, 6000000000 + users))
+        statuses = await asyncio.gather(*(client.deliver(start_update(index + 1, user_id))
+                                          for index, user_id in enumerate(user_ids)))
+        forged = await client.deliver(start_update(users + 1, 6999999999), secret_token='forged')
+        malformed = [
+            await client.deliver('{not json'),
+            await client.deliver('[1, 2]'),
+            await client.deliver({'message': {'text': '/start'}}),
+        ]
+        await bot.dispatcher.drain()
+        answered = {call.chat_id for call in api.sent()}
+        registered = [call for call in api.calls if call.method == 'setWebhook']
+        
+        # Один пользователь заваливает полосу, его соседи по полосе пишут по разу:
+        # отбрасываются только обновления сверх лимита заваливающего
+        flooder = 6100000000
+        neighbours = [flooder + DISPATCH_LANES * step for step in range(1, 6)]
+        api.calls.clear()
+        update_id = users + 100
+        flood_updates = [start_update(update_id + index, flooder) for index in range(flood)]
+        neighbour_updates = [start_update(update_id + flood + index, user_id) for index, user_id in enumerate(neighbours)]
+        flood_statuses = await asyncio.gather(*(client.deliver(update) for update in flood_updates + neighbour_updates))
+        await bot.dispatcher.drain()
+        flood_answers = [call.chat_id for call in api.sent()]
+    finally:
+        await client.stop()
+        await bot.dispatcher.stop()
+        await webhook.stop()
+        await bot.bot.close_session()
+        await api.stop()
+    
+    return [
+        ('setWebhook called', len(registered), 1),
+        ('accepted', statuses, [200] * users),
+        ('dispatched', sorted(answered & set(user_ids)), user_ids),
+        ('forged secret', forged, 403),
+        ('forged ignored', 6999999999 in answered, False),
+        ('malformed', malformed, [400, 400, 400]),
+        ('received stat', webhook.received, users + min(flood, bot.dispatcher.user_queue) + len(neighbours)),
+        ('flood acknowledged', flood_statuses, [200] * (flood + len(neighbours))),
+        ('flood capped', flood_answers.count(flooder), min(flood, bot.dispatcher.user_queue)),
+        ('neighbours served', sorted(set(flood_answers) & set(neighbours)), neighbours),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the webhook endpoint the way Telegram does and check dispatch")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--flood', type=int, default=60, help="updates sent at once by a single user")
+    args = parser.parse_args()
+    
+    failed = 0
+    for name, actual, expected in asyncio.run(check(args.users, args.flood)):
+        if actual == expected:
+            print(f"  {name:<18} ok")
+        else:
+            failed += 1
+            print(f"  {name:<18} FAILED\n    expected {expected}\n    actual   {actual}")
+    
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,548 @@
 import asyncio
+import cProfile
+import heapq
+import hmac
+import inspect
+import io
+import json
 import logging
+import logging.handlers
+import math
+import multiprocessing
+import os
+import pstats
+import queue
 import random
+import re
+import secrets
+import signal
+import socket
+import sqlite3
 import string
-from contextlib import asynccontextmanager
-from datetime import datetime, timedelta
-from typing import Dict, Optional, Tuple, Any
-from dataclasses import dataclass
+import sys
+import threading
+import time
+import traceback
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import Dict, Optional, Set, Tuple, Any
+from dataclasses import dataclass, field, fields
 
 import aiomysql
 from telebot.async_telebot import AsyncTeleBot
 from telebot import types
 from telebot.asyncio_helper import ApiException
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('bot.log', encoding='utf-8')
-    ]
-)
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+try:
+    from pymysqlreplication import BinLogStreamReader
+    from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+except ImportError:
+    BinLogStreamReader = None
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_FILE = os.environ.get('BOT_LOG_FILE', 'bot.log')
+# size - ротация по размеру файла, daily - в полночь
+LOG_ROTATE = os.environ.get('BOT_LOG_ROTATE', 'size')
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 10
+# В файл пишется по одному JSON-объекту на строку, в консоль - текст
+LOG_JSON = os.environ.get('BOT_LOG_JSON', '1') != '0'
+LOG_SAMPLE_INTERVAL = 60
+LOG_SAMPLE_BURST = 20
+
+class JsonFormatter(logging.Formatter):
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        event = getattr(record, 'event', None)
+        if event is not None:
+            entry['event'] = event
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging(level: int = logging.INFO) -> logging.handlers.QueueListener:
+    # Обработчики цикла событий только кладут запись в очередь, форматирование
+    # и запись на диск выполняет поток QueueListener
+    if LOG_ROTATE == 'daily':
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when='midnight', backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True
+        )
+    file_handler.setFormatter(JsonFormatter() if LOG_JSON else logging.Formatter(LOG_FORMAT))
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+class LogSampler:
+    
+    # Построчные сообщения (коды, восстановление при старте) пишутся не чаще
+    # burst раз за interval на ключ, остальные только считаются и выводятся
+    # одной итоговой строкой
+    
+    def __init__(self, target: logging.Logger, interval: float = LOG_SAMPLE_INTERVAL, burst: int = LOG_SAMPLE_BURST):
+        self.logger = target
+        self.interval = interval
+        self.burst = burst
+        # ключ -> [начало окна, сообщений в окне, подавлено]
+        self.windows: Dict[str, list] = {}
+    
+    def info(self, key: str, message: str):
+        self.log(logging.INFO, key, message)
+    
+    def log(self, level: int, key: str, message: str):
+        if not self.logger.isEnabledFor(level):
+            return
+        
+        now = time.monotonic()
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            if window is not None:
+                self.summarize(key, window, level)
+            window = self.windows[key] = [now, 0, 0]
+        
+        window[1] += 1
+        if window[1] <= self.burst:
+            self.logger.log(level, message, extra={'event': key})
+        else:
+            window[2] += 1
+    
+    def summarize(self, key: str, window: list, level: int = logging.INFO):
+        if window[2]:
+            self.logger.log(level, f"Пропущено похожих сообщений ({key}): {window[2]} "
+                                   f"за {time.monotonic() - window[0]:.0f} с", extra={'event': key})
+            window[2] = 0
+    
+    def flush(self, force: bool = False):
+        # Итог по ключам, окно которых закончилось без новых сообщений
+        now = time.monotonic()
+        for key, window in list(self.windows.items()):
+            if force or now - window[0] >= self.interval:
+                self.summarize(key, window)
+                del self.windows[key]
+
 logger = logging.getLogger('main_telebot')
+log_sampler = LogSampler(logger)
 
-@dataclass
+MONITOR_INTERVAL = 3
+
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+# Строки чужих шардов монитор этого процесса не видит и не обновляет в кеше:
+# они хранятся недолго, иначе привязка на другом шарде видна только через USER_CACHE_TTL
+USER_CACHE_UNOWNED_TTL = 5
+
+# Шардирование монитора: строки `telegram` делятся по id % BOT_SHARDS между
+# процессами, владение шардом подтверждается арендой в `telegram_shard_leases`
+SHARD_COUNT = int(os.environ.get('BOT_SHARDS', '1'))
+WORKER_ID = os.environ.get('BOT_WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}"
+# Обновления Telegram получает только один процесс, остальные лишь мониторят свои шарды
+POLL_UPDATES = os.environ.get('BOT_POLL_UPDATES', '1') != '0'
+# polling - infinity_polling, webhook - встроенный HTTP-сервер для обновлений Telegram
+UPDATE_MODE = os.environ.get('BOT_UPDATE_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('BOT_WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.environ.get('BOT_WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('BOT_WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('BOT_WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('BOT_WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = 40
+POLLING_TIMEOUT = 25
+
+# Обновления одного пользователя обрабатываются строго по порядку в своей
+# полосе, полосы разных пользователей работают параллельно
+DISPATCH_LANES = int(os.environ.get('BOT_DISPATCH_LANES', '32'))
+# Необработанных обновлений одного пользователя не больше DISPATCH_USER_QUEUE:
+# лишние обновления заваливающего бота пользователя отбрасываются, обновления
+# остальных пользователей его полосы принимаются всегда
+DISPATCH_USER_QUEUE = int(os.environ.get('BOT_DISPATCH_USER_QUEUE', '20'))
+
+SHARD_LEASE_TTL = 15
+SHARD_RENEW_INTERVAL = 5
+
+USER_STATE_TTL = 600
+CAPTCHA_TTL = 600
+STATE_PURGE_INTERVAL = 60
+# Путь к SQLite-файлу общего состояния; пусто - состояние хранится в памяти процесса
+STATE_DB_PATH = os.environ.get('BOT_STATE_DB', '')
+
+DB_POOL_MINSIZE = int(os.environ.get('BOT_DB_POOL_MIN', '1'))
+DB_POOL_MAXSIZE = int(os.environ.get('BOT_DB_POOL_MAX', '10'))
+DB_POOL_RECYCLE = 3600
+DB_CONNECT_TIMEOUT = 10
+DB_ACQUIRE_TIMEOUT = 5
+# Соединение, простоявшее дольше, проверяется ping перед выдачей
+DB_PING_IDLE = 30
+DB_CONNECT_ATTEMPTS = 6
+DB_RECONNECT_MAX_DELAY = 30
+DB_WAIT_WINDOW = 1000
+
+# Ограничение частоты действий пользователя: действие -> (токенов в секунду, емкость ведра).
+# Переопределяется JSON в BOT_THROTTLE_LIMITS, например {"addcode": [0.05, 2]}
+THROTTLE_LIMITS = {
+    'addcode': (1 / 10, 3),
+    'recovery': (1 / 300, 2),
+    'captcha': (1 / 30, 3),
+    'captcha_answer': (1.0, 5),
+    # Ответ "слишком много запросов" тоже ограничен, чтобы не тратить лимиты Bot API на спам
+    'notice': (1 / 30, 1),
+}
+THROTTLE_LIMITS.update({action: tuple(limit) for action, limit in
+                        json.loads(os.environ.get('BOT_THROTTLE_LIMITS', '{}')).items()})
+# Общий бюджет действий, обращающихся к БД, для всех пользователей
+THROTTLE_GLOBAL_RATE = float(os.environ.get('BOT_THROTTLE_GLOBAL_RATE', '200'))
+THROTTLE_GLOBAL_BURST = 400
+# Ведро, не использованное дольше THROTTLE_IDLE_TTL, заново заполнено и удаляется
+THROTTLE_IDLE_TTL = 600
+THROTTLE_MAX_BUCKETS = 100000
+
+WRITE_BATCH_WINDOW = 0.005
+WRITE_BATCH_SIZE = 200
+FEED_BATCH_SIZE = 1000
+# Прогрев снимка читает `telegram` серверным курсором порциями по WARMUP_CHUNK_SIZE строк
+WARMUP_CHUNK_SIZE = 5000
+# Полный скан не меньше DIFF_OFFLOAD_ROWS строк сравнивается со снимком в пуле
+# процессов частями примерно по DIFF_PARTITION_ROWS строк; меньший - в цикле событий
+DIFF_OFFLOAD_ROWS = int(os.environ.get('BOT_DIFF_OFFLOAD_ROWS', '50000'))
+DIFF_PARTITION_ROWS = 5000
+FEED_OVERLAP = 200
+FEED_RETENTION_HOURS = 24
+FEED_PRUNE_INTERVAL = 3600
+
+# poll - опрос таблицы (лента изменений или полный скан), binlog - чтение row-based binlog
+EVENT_SOURCE = os.environ.get('BOT_EVENT_SOURCE', 'poll')
+BINLOG_SERVER_ID = int(os.environ.get('BOT_BINLOG_SERVER_ID', '4242'))
+BINLOG_MAX_RETRIES = 5
+
+EXPIRE_BATCH_SIZE = 500
+EXPIRE_RETRY_DELAY = 10
+
+PRIORITY_CODE = 0
+PRIORITY_BINDING = 1
+PRIORITY_BROADCAST = 2
+PRIORITY_NAMES = {PRIORITY_CODE: 'code', PRIORITY_BINDING: 'binding', PRIORITY_BROADCAST: 'broadcast'}
+SEND_WORKERS = 8
+# Лимит на весь бот: при шардировании каждый процесс берет SEND_GLOBAL_RATE / число процессов
+SEND_GLOBAL_RATE = 30
+SEND_CHAT_INTERVAL = 1.0
+SEND_MAX_ATTEMPTS = 3
+# Повтор после сетевой ошибки: SEND_RETRY_DELAY, затем вдвое дольше с каждой попыткой
+SEND_RETRY_DELAY = 1.0
+SEND_LATENCY_WINDOW = 1000
+
+# Рассылки запускают администраторы из BOT_ADMIN_IDS (tg_id через запятую)
+ADMIN_IDS = {int(tg_id) for tg_id in os.environ.get('BOT_ADMIN_IDS', '').split(',') if tg_id.strip()}
+# Рассылка занимает не больше BROADCAST_RATE сообщений/с из SEND_GLOBAL_RATE,
+# остаток всегда свободен для кодов и уведомлений о привязке
+BROADCAST_RATE = float(os.environ.get('BOT_BROADCAST_RATE', '25'))
+BROADCAST_CHUNK_SIZE = 1000
+# Сообщений рассылки в очереди отправки одновременно
+BROADCAST_WINDOW = 100
+BROADCAST_CHECKPOINT_INTERVAL = 5
+BROADCAST_LEASE_TTL = 60
+BROADCAST_POLL_INTERVAL = 30
+
+# Упавшая фоновая задача перезапускается с задержкой от SUPERVISOR_BASE_DELAY
+# до SUPERVISOR_MAX_DELAY; после SUPERVISOR_STABLE_AFTER секунд работы задержка сбрасывается
+SUPERVISOR_BASE_DELAY = 1.0
+SUPERVISOR_MAX_DELAY = 60.0
+SUPERVISOR_STABLE_AFTER = 300
+# По SIGTERM/SIGINT бот за SHUTDOWN_DEADLINE секунд дорабатывает принятые обновления,
+# отправляет очередь уведомлений и обнуляет коды, истекающие в пределах этого срока
+SHUTDOWN_DEADLINE = float(os.environ.get('BOT_SHUTDOWN_DEADLINE', '20'))
+
+# Пул потоков для блокирующих операций и пул процессов для сравнения больших сканов (0 - без процессов)
+EXECUTOR_THREADS = int(os.environ.get('BOT_EXECUTOR_THREADS', '4'))
+EXECUTOR_PROCESSES = int(os.environ.get('BOT_EXECUTOR_PROCESSES', '2'))
+
+# Задержка цикла событий замеряется всегда; BOT_PROFILE=1 включает сторож,
+# который снимает стек цикла, заблокированного дольше SLOW_CALLBACK_THRESHOLD.
+# SIGUSR1 - дамп стеков задач и потоков, SIGUSR2 - cProfile на PROFILE_DURATION секунд
+PROFILE_ENABLED = os.environ.get('BOT_PROFILE', '0') != '0'
+PROFILE_DIR = os.environ.get('BOT_PROFILE_DIR', '.')
+PROFILE_DURATION = 30
+PROFILE_TOP = 30
+LOOP_LAG_INTERVAL = 0.5
+SLOW_CALLBACK_THRESHOLD = float(os.environ.get('BOT_SLOW_CALLBACK', '0.1'))
+STALL_STACK_LIMIT = 20
+
+# Метрики в текстовом формате Prometheus на http://METRICS_LISTEN:METRICS_PORT/metrics, 0 - выключено
+METRICS_LISTEN = os.environ.get('BOT_METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('BOT_METRICS_PORT', '9108'))
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Атомарная выдача кода (upsert_code) опирается на уникальность tg_id;
+# без этого индекса используется прежний путь SELECT + UPDATE/INSERT.
+# BOT_MIGRATE_SCHEMA=1 создает индекс при запуске, если в таблице нет дублей tg_id
+TELEGRAM_TG_ID_UNIQUE_DDL = "ALTER TABLE telegram ADD UNIQUE KEY uniq_tg_id (tg_id)"
+MIGRATE_SCHEMA = os.environ.get('BOT_MIGRATE_SCHEMA', '0') == '1'
+
+# Лента изменений: игровой сервер пишет в `telegram` как раньше, триггеры
+# добавляют id измененной строки в `telegram_events`, монитор читает только новые события
+TELEGRAM_EVENTS_DDL = (
+    """CREATE TABLE IF NOT EXISTS telegram_events (
+        event_id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        row_id INT NOT NULL,
+        created_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+        KEY idx_created_at (created_at)
+    )""",
+    "CREATE TRIGGER telegram_events_ai AFTER INSERT ON telegram FOR EACH ROW "
+    "INSERT INTO telegram_events (row_id) VALUES (NEW.id)",
+    "CREATE TRIGGER telegram_events_au AFTER UPDATE ON telegram FOR EACH ROW "
+    "INSERT INTO telegram_events (row_id) VALUES (NEW.id)",
+    "CREATE TRIGGER telegram_events_ad AFTER DELETE ON telegram FOR EACH ROW "
+    "INSERT INTO telegram_events (row_id) VALUES (OLD.id)",
+)
+
+TELEGRAM_SHARDS_DDL = (
+    """CREATE TABLE IF NOT EXISTS telegram_shard_leases (
+        shard INT NOT NULL PRIMARY KEY,
+        owner VARCHAR(128) NOT NULL DEFAULT '',
+        expires_at DATETIME(3) NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS telegram_workers (
+        worker_id VARCHAR(128) NOT NULL PRIMARY KEY,
+        seen_at DATETIME(3) NOT NULL
+    )""",
+)
+
+# Рассылки и заблокировавшие бота пользователи; last_row_id - id строки `telegram`,
+# до которой включительно рассылка обработана, owner/lease_until - процесс, ведущий рассылку
+TELEGRAM_BROADCAST_DDL = (
+    """CREATE TABLE IF NOT EXISTS telegram_broadcasts (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        text TEXT NOT NULL,
+        created_by BIGINT NOT NULL,
+        status VARCHAR(16) NOT NULL DEFAULT 'running',
+        last_row_id INT NOT NULL DEFAULT 0,
+        sent INT NOT NULL DEFAULT 0,
+        failed INT NOT NULL DEFAULT 0,
+        blocked INT NOT NULL DEFAULT 0,
+        owner VARCHAR(128) NOT NULL DEFAULT '',
+        lease_until DATETIME(3) NOT NULL DEFAULT '1970-01-01 00:00:01',
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP NULL DEFAULT NULL,
+        KEY idx_status (status)
+    )""",
+    """CREATE TABLE IF NOT EXISTS telegram_blocked (
+        tg_id BIGINT NOT NULL PRIMARY KEY,
+        blocked_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )""",
+)
+
+def format_labels(labels: Tuple[Tuple[str, Any], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+class Counter:
+    
+    kind = 'counter'
+    
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values: Dict[Tuple, float] = {}
+    
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + value
+    
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+class Gauge(Counter):
+    
+    kind = 'gauge'
+    
+    def __init__(self, name: str, help_text: str, callback=None, labels: Tuple[str, ...] = ('stat',)):
+        super().__init__(name, help_text)
+        # callback() -> число или {значение метки (кортеж для нескольких меток): число};
+        # вызывается при каждом чтении /metrics
+        self.callback = callback
+        self.labels = labels
+    
+    def set(self, value: float, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+    
+    def samples(self):
+        if self.callback is None:
+            yield from super().samples()
+            return
+        
+        value = self.callback()
+        if isinstance(value, dict):
+            for label_values, item in value.items():
+                if not isinstance(label_values, tuple):
+                    label_values = (label_values,)
+                yield self.name, tuple(zip(self.labels, label_values)), item
+        else:
+            yield self.name, (), value
+
+class Histogram:
+    
+    kind = 'histogram'
+    
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # метки -> [счетчики по корзинам (последняя +Inf), сумма, количество]
+        self.series: Dict[Tuple, list] = {}
+    
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def samples(self):
+        for key, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f"{self.name}_bucket", key + (('le', le),), cumulative
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+class MetricsRegistry:
+    
+    def __init__(self):
+        self.metrics: Dict[str, Any] = {}
+        self.server = None
+    
+    def register(self, metric):
+        # Повторная регистрация под тем же именем заменяет метрику (например,
+        # gauge с callback на компонент нового экземпляра бота)
+        self.metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self.register(Counter(name, help_text))
+    
+    def gauge(self, name: str, help_text: str, callback=None, labels: Tuple[str, ...] = ('stat',)) -> Gauge:
+        return self.register(Gauge(name, help_text, callback, labels))
+    
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = METRICS_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, buckets))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                logger.warning(f"Metric {metric.name} failed: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {float(value)!r}")
+        return "\n".join(lines) + "\n"
+    
+    async def handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    async def start(self, host: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        # Порт может быть занят другим процессом бота на этом же хосте (шарды,
+        # несколько серверов): без метрик процесс продолжает работать
+        try:
+            self.server = await asyncio.start_server(self.handle_request, host, port)
+        except OSError as e:
+            logger.error(f"Metrics endpoint disabled, cannot listen on {host}:{port}: {e}")
+            return
+        logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram('bot_handler_seconds', 'Handler latency by command, callback action or dialog state')
+HANDLER_ERRORS = metrics.counter('bot_handler_errors_total', 'Unhandled exceptions in handlers')
+DB_QUERY_LATENCY = metrics.histogram('bot_db_query_seconds', 'MySQL query latency by named query (after pool acquire)')
+MONITOR_TICK = metrics.histogram('bot_monitor_tick_seconds', 'Duration of one monitor pass over `telegram`')
+MONITOR_ROWS = metrics.counter('bot_monitor_rows_scanned_total', 'Rows read by the monitor by source')
+DELIVERY_LATENCY = metrics.histogram('bot_notification_delivery_seconds',
+                                     'Time from the database change to the sent Telegram message')
+API_ERRORS = metrics.counter('bot_telegram_api_errors_total', 'Telegram Bot API errors by method and error code')
+API_RATE_LIMITED = metrics.counter('bot_telegram_rate_limited_total', 'Telegram Bot API 429 responses by method')
+
+THROTTLE_REJECTED = metrics.counter('bot_throttle_rejected_total', 'Requests rejected by throttling by action and scope')
+TASK_RESTARTS = metrics.counter('bot_task_restarts_total', 'Background task restarts after a crash')
+LOOP_LAG = metrics.histogram('bot_event_loop_lag_seconds', 'How late the event loop wakes up a sleeping coroutine')
+LOOP_STALLS = metrics.counter('bot_event_loop_stalls_total', 'Event loop stalls over the threshold by asyncio task')
+
+def record_api_error(method: str, error: Exception):
+    error_code = getattr(error, 'error_code', None) or 'network'
+    API_ERRORS.inc(method=method, code=error_code)
+    if error_code == 429:
+        API_RATE_LIMITED.inc(method=method)
+
+@dataclass(slots=True)
 class UserData:
     id: int
     owner_id: int
@@ -32,187 +552,2787 @@ class UserData:
     player_name: Optional[str]
     type_name: Optional[str]
 
-@dataclass
+USER_FIELDS = tuple(field.name for field in fields(UserData))
+
+@dataclass(slots=True)
 class CodeInfo:
     code: int
-    expiry_time: datetime
+    expires_at: float
     tg_id: int
 
-class DatabaseManager:
+@dataclass
+class ServerConfig:
+    name: str
+    db_config: Dict[str, Any]
+    accounts_table: str = 'accounts_1101'
+
+DEFAULT_SERVER = ServerConfig('01', {
+    "host": "195.18.27.241",
+    "user": "gs103649",
+    "password": "phz3eitw",
+    "db": "gs103649",
+})
+
+def load_servers() -> list:
+    # BOT_SERVERS - JSON-список серверов: [{"name": "02", "host": ..., "user": ...,
+    # "password": ..., "db": ..., "accounts_table": "accounts_1102"}, ...]; без него - один сервер 01
+    raw = os.environ.get('BOT_SERVERS')
+    if not raw:
+        return [DEFAULT_SERVER]
+    
+    servers = []
+    for entry in json.loads(raw):
+        entry = dict(entry)
+        name = str(entry.pop('name'))
+        accounts_table = entry.pop('accounts_table', DEFAULT_SERVER.accounts_table)
+        # Имя таблицы подставляется в SQL, поэтому допускаются только буквы, цифры и _
+        if not accounts_table.replace('_', '').isalnum() or not name.replace('_', '').isalnum():
+            raise ValueError(f"Invalid server config: {name}/{accounts_table}")
+        servers.append(ServerConfig(name, entry, accounts_table))
+    if len({server.name for server in servers}) != len(servers):
+        raise ValueError("Server names in BOT_SERVERS must be unique")
+    return servers
+
+class TelegramSnapshot:
+    
+    # Снимок таблицы `telegram` по колонкам: числовые поля в array('q'),
+    # строки в списках, id -> позиция в словаре. UserData собирается только
+    # для измененных строк, удаление переносит последнюю строку на место удаленной
     
     def __init__(self):
+        self.index: Dict[int, int] = {}
+        self.ids = array('q')
+        self.owner_ids = array('q')
+        self.tg_ids = array('q')
+        self.codes = array('q')
+        self.usernames: list = []
+        self.player_names: list = []
+        self.type_names: list = []
+        self.columns = (self.ids, self.owner_ids, self.tg_ids, self.codes,
+                        self.usernames, self.player_names, self.type_names)
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def __contains__(self, row_id: int) -> bool:
+        return row_id in self.index
+    
+    def row(self, pos: int) -> UserData:
+        return UserData(self.ids[pos], self.owner_ids[pos], self.tg_ids[pos], self.codes[pos],
+                        self.usernames[pos], self.player_names[pos], self.type_names[pos])
+    
+    def get(self, row_id: int) -> Optional[UserData]:
+        pos = self.index.get(row_id)
+        return None if pos is None else self.row(pos)
+    
+    def apply_row(self, row: Dict[str, Any]) -> Tuple[bool, Optional[UserData]]:
+        row_id = row['id']
+        owner_id = row['owner_id'] or 0
+        tg_id = row['tg_id'] or 0
+        code = row['code'] or 0
+        pos = self.index.get(row_id)
+        
+        if pos is None:
+            self.index[row_id] = len(self.ids)
+            self.ids.append(row_id)
+            self.owner_ids.append(owner_id)
+            self.tg_ids.append(tg_id)
+            self.codes.append(code)
+            self.usernames.append(row['tg_usname'])
+            self.player_names.append(row['player_name'])
+            self.type_names.append(row['type_name'])
+            return True, None
+        
+        if (self.codes[pos] == code and self.owner_ids[pos] == owner_id and
+                self.tg_ids[pos] == tg_id and self.usernames[pos] == row['tg_usname'] and
+                self.player_names[pos] == row['player_name'] and self.type_names[pos] == row['type_name']):
+            return False, None
+        
+        old_data = self.row(pos)
+        self.owner_ids[pos] = owner_id
+        self.tg_ids[pos] = tg_id
+        self.codes[pos] = code
+        self.usernames[pos] = row['tg_usname']
+        self.player_names[pos] = row['player_name']
+        self.type_names[pos] = row['type_name']
+        return True, old_data
+    
+    def sync(self, rows) -> Tuple[list, list]:
+        # Сравнение полного скана со снимком на месте: возвращает только
+        # измененные строки (id, старые данные или None для новых) и удаленные id
+        seen = bytearray(len(self.ids))
+        changes = []
+        
+        for row in rows:
+            pos = self.index.get(row['id'])
+            if pos is not None:
+                seen[pos] = 1
+            changed, old_data = self.apply_row(row)
+            if changed:
+                changes.append((row['id'], old_data))
+        
+        removed = [self.ids[pos] for pos, flag in enumerate(seen) if not flag]
+        return changes, removed
+    
+    def set_code(self, row_id: int, code: int, expected: Optional[int] = None) -> bool:
+        pos = self.index.get(row_id)
+        if pos is None or (expected is not None and self.codes[pos] != expected):
+            return False
+        self.codes[pos] = code
+        return True
+    
+    def remove(self, row_id: int) -> Optional[UserData]:
+        pos = self.index.pop(row_id, None)
+        if pos is None:
+            return None
+        
+        user_data = self.row(pos)
+        last = len(self.ids) - 1
+        if pos != last:
+            for column in self.columns:
+                column[pos] = column[last]
+            self.index[self.ids[pos]] = pos
+        for column in self.columns:
+            column.pop()
+        return user_data
+
+def new_partitions(parts: int) -> list:
+    # Колонки в порядке USER_FIELDS: числа в array('q'), строки в списках
+    return [(array('q'), array('q'), array('q'), array('q'), [], [], []) for _ in range(parts)]
+
+def partition_snapshot(columns: tuple, parts: int) -> list:
+    # Колонки снимка, разложенные по остатку id % parts: одна часть
+    # пересылается в процесс пула за раз и не держит GIL надолго при сериализации.
+    # Выполняется в потоке: каждая колонка копируется атомарно под GIL, цикл
+    # событий не ждет копирования всего снимка
+    columns = [column[:] for column in columns]
+    partitions = new_partitions(parts)
+    ids = columns[0]
+    for pos in range(len(ids)):
+        part = partitions[ids[pos] % parts]
+        for column, values in zip(part, columns):
+            column.append(values[pos])
+    return partitions
+
+def partition_rows(rows: list, partitions: list):
+    parts = len(partitions)
+    for row in rows:
+        part = partitions[row['id'] % parts]
+        part[0].append(row['id'])
+        part[1].append(row['owner_id'] or 0)
+        part[2].append(row['tg_id'] or 0)
+        part[3].append(row['code'] or 0)
+        part[4].append(row['tg_usname'])
+        part[5].append(row['player_name'])
+        part[6].append(row['type_name'])
+
+def partition_row(part: tuple, index: int) -> Dict[str, Any]:
+    return dict(zip(USER_FIELDS, (column[index] for column in part)))
+
+def diff_partition(snapshot_part: tuple, scan_part: tuple) -> Tuple[list, list]:
+    # Выполняется в процессе пула: индексы строк части скана, которых нет в
+    # снимке или которые отличаются от него, и id строк снимка, пропавших из скана
+    ids, owner_ids, tg_ids, codes, usernames, player_names, type_names = snapshot_part
+    scan_ids, scan_owner_ids, scan_tg_ids, scan_codes, scan_usernames, scan_player_names, scan_type_names = scan_part
+    index = {row_id: pos for pos, row_id in enumerate(ids)}
+    seen = bytearray(len(ids))
+    changed = []
+    
+    for i, row_id in enumerate(scan_ids):
+        pos = index.get(row_id)
+        if pos is None:
+            changed.append(i)
+            continue
+        seen[pos] = 1
+        if (codes[pos] != scan_codes[i] or owner_ids[pos] != scan_owner_ids[i] or
+                tg_ids[pos] != scan_tg_ids[i] or usernames[pos] != scan_usernames[i] or
+                player_names[pos] != scan_player_names[i] or type_names[pos] != scan_type_names[i]):
+            changed.append(i)
+    
+    removed = [ids[pos] for pos, flag in enumerate(seen) if not flag]
+    return changed, removed
+
+class Executors:
+    
+    # Пул потоков для блокирующего ввода-вывода и подготовки данных и пул
+    # процессов для сравнения больших сканов. Процессы запускаются (spawn) при
+    # первом обращении; при processes=0 такая работа выполняется в пуле потоков
+    
+    def __init__(self, threads: int = EXECUTOR_THREADS, processes: int = EXECUTOR_PROCESSES):
+        self.threads = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='bot-io')
+        self.processes_count = processes
+        self.processes: Optional[ProcessPoolExecutor] = None
+        self.thread_calls = 0
+        self.process_calls = 0
+        self.in_flight = 0
+    
+    async def run(self, executor, func, *args):
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        finally:
+            self.in_flight -= 1
+    
+    async def in_thread(self, func, *args, executor: Optional[ThreadPoolExecutor] = None):
+        # executor - свой поток вызывающего (например, единственное соединение SQLite)
+        self.thread_calls += 1
+        return await self.run(executor or self.threads, func, *args)
+    
+    async def in_process(self, func, *args):
+        if not self.processes_count:
+            return await self.in_thread(func, *args)
+        if self.processes is None:
+            self.processes = ProcessPoolExecutor(max_workers=self.processes_count,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        self.process_calls += 1
+        return await self.run(self.processes, func, *args)
+    
+    def submit_thread(self, func, *args):
+        # Фоновая работа без ожидания результата (очистка хранилища, запись дампов)
+        self.thread_calls += 1
+        future = self.threads.submit(func, *args)
+        future.add_done_callback(self.log_failure)
+        return future
+    
+    @staticmethod
+    def log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Ошибка фоновой операции в пуле потоков: {future.exception()}")
+    
+    def shutdown(self):
+        self.threads.shutdown(wait=True, cancel_futures=True)
+        if self.processes is not None:
+            self.processes.shutdown(wait=True, cancel_futures=True)
+            self.processes = None
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'thread_calls': self.thread_calls,
+            'process_calls': self.process_calls,
+            'in_flight': self.in_flight,
+            'processes_started': int(self.processes is not None),
+        }
+
+executors = Executors()
+
+class UserCache:
+    
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL,
+                 unowned_ttl: float = USER_CACHE_UNOWNED_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.unowned_ttl = unowned_ttl
+        # id строки -> принадлежит ли она шардам этого процесса; None - шардирования нет
+        self.owns = None
+        # tg_id -> (UserData или None, если строки нет; время истечения)
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Счетчик записей: чтение из БД, начатое до записи, не кладет в кеш старые данные
+        self.writes = 0
+    
+    def lookup(self, tg_id: int) -> Tuple[bool, Optional[UserData]]:
+        entry = self.entries.get(tg_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self.entries[tg_id]
+            self.misses += 1
+            return False, None
+        
+        self.entries.move_to_end(tg_id)
+        self.hits += 1
+        return True, entry[0]
+    
+    def put(self, tg_id: int, user_data: Optional[UserData]):
+        ttl = self.ttl
+        if user_data is not None and self.owns is not None and not self.owns(user_data.id):
+            ttl = self.unowned_ttl
+        self.entries[tg_id] = (user_data, time.monotonic() + ttl)
+        self.entries.move_to_end(tg_id)
+        
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+    
+    def refresh(self, user_data: UserData):
+        # Снимки монитора обновляют только уже закешированных пользователей,
+        # чтобы полный скан не вытеснял из кеша активных
+        if user_data.tg_id in self.entries:
+            self.put(user_data.tg_id, user_data)
+    
+    def fill(self, tg_id: int, user_data: Optional[UserData], writes_seen: int):
+        if writes_seen == self.writes:
+            self.put(tg_id, user_data)
+    
+    def invalidate(self, tg_id: int):
+        self.writes += 1
+        self.entries.pop(tg_id, None)
+    
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+class Throttle:
+    
+    # Token bucket на пару (действие, tg_id) и общий на все действия с БД.
+    # Ведра лежат в OrderedDict по времени последнего обращения: проверка O(1),
+    # простаивающие ведра вытесняются с начала
+    
+    def __init__(self, limits: Dict[str, Tuple[float, float]] = THROTTLE_LIMITS,
+                 global_rate: float = THROTTLE_GLOBAL_RATE, global_burst: float = THROTTLE_GLOBAL_BURST,
+                 idle_ttl: float = THROTTLE_IDLE_TTL, max_buckets: int = THROTTLE_MAX_BUCKETS):
+        self.limits = limits
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.idle_ttl = idle_ttl
+        self.max_buckets = max_buckets
+        # (действие, tg_id) -> [токены, время обновления]
+        self.buckets: OrderedDict = OrderedDict()
+        self.global_bucket = [float(global_burst), time.monotonic()]
+        self.allowed = 0
+        self.rejected = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def refill(bucket: list, rate: float, burst: float, now: float):
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+    
+    def check(self, tg_id: int, action: str, use_global: bool = True) -> float:
+        # 0 - действие разрешено и токены списаны, иначе через сколько секунд повторить
+        now = time.monotonic()
+        rate, burst = self.limits[action]
+        key = (action, tg_id)
+        
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(burst), now]
+            self.evict(now)
+        else:
+            self.buckets.move_to_end(key)
+            self.refill(bucket, rate, burst, now)
+        
+        if bucket[0] < 1:
+            return self.reject(action, 'user', (1 - bucket[0]) / rate)
+        
+        if use_global:
+            self.refill(self.global_bucket, self.global_rate, self.global_burst, now)
+            if self.global_bucket[0] < 1:
+                return self.reject(action, 'global', (1 - self.global_bucket[0]) / self.global_rate)
+            self.global_bucket[0] -= 1
+        
+        bucket[0] -= 1
+        self.allowed += 1
+        return 0.0
+    
+    def reject(self, action: str, scope: str, retry_after: float) -> float:
+        self.rejected += 1
+        THROTTLE_REJECTED.inc(action=action, scope=scope)
+        return max(retry_after, 0.001)
+    
+    def evict(self, now: float):
+        buckets = self.buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if now - bucket[1] < self.idle_ttl and len(buckets) <= self.max_buckets:
+                break
+            del buckets[key]
+            self.evictions += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'buckets': len(self.buckets),
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+            'evictions': self.evictions,
+        }
+
+@lru_cache(maxsize=512)
+def sql_placeholders(count: int, group: str = "%s", separator: str = ", ") -> str:
+    return separator.join([group] * count)
+
+class WriteBatcher:
+    
+    # Записи одного вида, пришедшие в пределах окна, выполняются одним запросом.
+    # Повторная запись по тому же ключу с теми же параметрами присоединяется к
+    # первой, с другими - заменяет ее (побеждает последняя): вызывающие с
+    # замененными параметрами сразу получают False, их запись не выполнена
+    
+    def __init__(self, handlers: Dict[str, Any], window: float = WRITE_BATCH_WINDOW,
+                 max_batch: int = WRITE_BATCH_SIZE):
+        self.handlers = handlers
+        self.window = window
+        self.max_batch = max_batch
+        self.pending: Dict[str, Dict[Any, list]] = {}
+        self.timers: Dict[str, asyncio.TimerHandle] = {}
+        self.tasks: set = set()
+        self.batches = 0
+        self.writes = 0
+    
+    def submit(self, kind: str, key: Any, params: tuple) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.setdefault(kind, {})
+        
+        entry = batch.get(key)
+        if entry is None:
+            batch[key] = [params, [future]]
+        elif entry[0] == params:
+            entry[1].append(future)
+        else:
+            for superseded in entry[1]:
+                if not superseded.done():
+                    superseded.set_result(False)
+            batch[key] = [params, [future]]
+        
+        if len(batch) >= self.max_batch:
+            self.flush(kind)
+        elif kind not in self.timers:
+            self.timers[kind] = loop.call_later(self.window, self.flush, kind)
+        return future
+    
+    def flush(self, kind: str):
+        timer = self.timers.pop(kind, None)
+        if timer is not None:
+            timer.cancel()
+        
+        batch = self.pending.pop(kind, None)
+        if batch:
+            task = asyncio.create_task(self.run_batch(kind, batch), name=f"write-batch:{kind}")
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+    
+    async def run_batch(self, kind: str, batch: Dict[Any, list]):
+        self.batches += 1
+        self.writes += len(batch)
+        
+        try:
+            results = await self.handlers[kind]({key: entry[0] for key, entry in batch.items()})
+        except Exception as e:
+            results = {key: e for key in batch}
+        
+        for key, (_, futures) in batch.items():
+            result = results.get(key, False)
+            for future in futures:
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+    
+    async def drain(self):
+        for kind in list(self.pending):
+            self.flush(kind)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+class DatabaseManager:
+    
+    def __init__(self, server: Optional[ServerConfig] = None):
+        self.server = server or DEFAULT_SERVER
         self.db_config = {
-            "host": "195.18.27.241",
-            "user": "gs103649",
-            "password": "phz3eitw",
-            "db": "gs103649",
+            **self.server.db_config,
             "autocommit": True,
-            "minsize": 1,
-            "maxsize": 10
+            "minsize": DB_POOL_MINSIZE,
+            "maxsize": DB_POOL_MAXSIZE,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "connect_timeout": DB_CONNECT_TIMEOUT
         }
         self.pool = None
+        # Отдельное соединение монитора: сканирование таблицы не занимает
+        # соединения пула, нужные интерактивным обработчикам
+        self.monitor_conn = None
+        self.monitor_lock = asyncio.Lock()
+        self.user_cache = UserCache()
+        self.tg_id_unique: Optional[bool] = None
+        self.batcher = WriteBatcher({
+            'update_code': self.flush_code_updates,
+            'insert': self.flush_inserts,
+            'delete': self.flush_deletes,
+        })
+        self.acquire_waits: deque = deque(maxlen=DB_WAIT_WINDOW)
+        self.acquire_timeouts = 0
+        self.pings = 0
+        self.reconnects = 0
+    
+    async def initialize(self):
+        try:
+            self.pool = await self.with_backoff(
+                lambda: aiomysql.create_pool(**self.db_config), "database pool"
+            )
+            logger.info(f"Database connection pool initialized for server {self.server.name}")
+        except Exception as e:
+            logger.error(f"Failed to initialize database pool for server {self.server.name}: {e}")
+            raise
+    
+    async def with_backoff(self, connect, name: str):
+        for attempt in range(DB_CONNECT_ATTEMPTS):
+            try:
+                return await connect()
+            except (aiomysql.OperationalError, OSError, asyncio.TimeoutError) as e:
+                if attempt == DB_CONNECT_ATTEMPTS - 1:
+                    raise
+                delay = min(2 ** attempt, DB_RECONNECT_MAX_DELAY)
+                self.reconnects += 1
+                logger.warning(f"Could not connect {name} of server {self.server.name} ({e}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+    
+    async def close(self):
+        # Накопленные в окне записи выполняются до закрытия пула
+        if self.pool:
+            await self.batcher.drain()
+        if self.monitor_conn is not None:
+            self.monitor_conn.close()
+            self.monitor_conn = None
+        if self.pool:
+            self.pool.close()
+            await self.pool.wait_closed()
+    
+    async def ensure_alive(self, conn):
+        if asyncio.get_running_loop().time() - conn.last_usage > DB_PING_IDLE:
+            self.pings += 1
+            await conn.ping(reconnect=True)
+    
+    @asynccontextmanager
+    async def acquire(self):
+        started = time.monotonic()
+        try:
+            conn = await asyncio.wait_for(self.pool.acquire(), DB_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            raise
+        self.acquire_waits.append(time.monotonic() - started)
+        
+        try:
+            await self.ensure_alive(conn)
+            yield conn
+        except (aiomysql.OperationalError, aiomysql.InterfaceError):
+            # Оборванное соединение закрывается, пул не вернет его повторно
+            conn.close()
+            raise
+        finally:
+            self.pool.release(conn)
+    
+    @asynccontextmanager
+    async def get_cursor(self, monitor: bool = False, name: str = 'other', cursor_class=aiomysql.DictCursor):
+        # name - метка запроса в bot_db_query_seconds; ожидание пула в нее не входит
+        if monitor:
+            async with self.monitor_connection() as conn:
+                async with conn.cursor(cursor_class) as cursor:
+                    with DB_QUERY_LATENCY.time(server=self.server.name, query=name):
+                        yield cursor
+            return
+        
+        async with self.acquire() as conn:
+            async with conn.cursor(cursor_class) as cursor:
+                try:
+                    with DB_QUERY_LATENCY.time(server=self.server.name, query=name):
+                        yield cursor
+                finally:
+                    await cursor.close()
+    
+    @asynccontextmanager
+    async def monitor_connection(self):
+        async with self.monitor_lock:
+            if self.monitor_conn is None or self.monitor_conn.closed:
+                config = {key: value for key, value in self.db_config.items()
+                          if key not in ('minsize', 'maxsize', 'pool_recycle')}
+                self.monitor_conn = await self.with_backoff(
+                    lambda: aiomysql.connect(**config), "monitor connection"
+                )
+            
+            try:
+                await self.ensure_alive(self.monitor_conn)
+                yield self.monitor_conn
+            except (aiomysql.OperationalError, aiomysql.InterfaceError):
+                self.monitor_conn.close()
+                self.monitor_conn = None
+                raise
+    
+    async def execute_query(self, query: str, params: tuple = None, monitor: bool = False,
+                            name: str = 'other') -> Any:
+        async with self.get_cursor(monitor, name) as cursor:
+            await cursor.execute(query, params or ())
+            return await cursor.fetchall()
+    
+    async def execute_update(self, query: str, params: tuple = None, monitor: bool = False,
+                             name: str = 'other') -> int:
+        async with self.get_cursor(monitor, name) as cursor:
+            await cursor.execute(query, params or ())
+            return cursor.rowcount
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        waits = sorted(self.acquire_waits)
+        size = self.pool.size if self.pool else 0
+        free = self.pool.freesize if self.pool else 0
+        return {
+            'size': size,
+            'free': free,
+            'max_size': self.db_config['maxsize'],
+            'utilization': (size - free) / self.db_config['maxsize'],
+            'acquire_wait_p50': waits[len(waits) // 2] if waits else 0.0,
+            'acquire_wait_p99': waits[int(len(waits) * 0.99)] if waits else 0.0,
+            'acquire_timeouts': self.acquire_timeouts,
+            'pings': self.pings,
+            'reconnects': self.reconnects,
+        }
+    
+    async def get_user_by_tg_id(self, tg_id: int) -> Optional[UserData]:
+        cached, user_data = self.user_cache.lookup(tg_id)
+        if cached:
+            return user_data
+        
+        writes_seen = self.user_cache.writes
+        result = await self.execute_query(
+            "SELECT id, owner_id, tg_id, code, tg_usname, player_name, type_name FROM telegram WHERE tg_id = %s",
+            (tg_id,),
+            name='get_user_by_tg_id'
+        )
+        user_data = UserData(**result[0]) if result else None
+        self.user_cache.fill(tg_id, user_data, writes_seen)
+        return user_data
+    
+    async def update_user_code(self, tg_id: int, code: int, username: str) -> bool:
+        result = await self.batcher.submit('update_code', tg_id, (code, username))
+        self.user_cache.invalidate(tg_id)
+        return result
+    
+    async def insert_user(self, tg_id: int, code: int, username: str) -> bool:
+        result = await self.batcher.submit('insert', tg_id, (code, username))
+        self.user_cache.invalidate(tg_id)
+        return result
+    
+    async def delete_user(self, tg_id: int) -> bool:
+        result = await self.batcher.submit('delete', tg_id, ())
+        self.user_cache.invalidate(tg_id)
+        self.user_cache.put(tg_id, None)
+        return result
+    
+    async def has_unique_tg_id(self) -> bool:
+        if self.tg_id_unique is None:
+            result = await self.execute_query(
+                "SHOW INDEX FROM telegram WHERE Non_unique = 0",
+                name='has_unique_tg_id'
+            )
+            # ON DUPLICATE KEY UPDATE срабатывает по tg_id, только если уникальный
+            # ключ состоит из одного tg_id, а не содержит его среди других колонок
+            key_columns: Dict[str, Set[str]] = {}
+            for row in result:
+                key_columns.setdefault(row['Key_name'], set()).add(row['Column_name'])
+            self.tg_id_unique = {'tg_id'} in key_columns.values()
+            if not self.tg_id_unique:
+                logger.warning("telegram.tg_id has no unique index, code requests use SELECT + UPDATE/INSERT")
+        return self.tg_id_unique
+    
+    async def create_unique_tg_id(self) -> bool:
+        # Дубли tg_id, оставшиеся от неатомарной выдачи кодов, разбираются вручную:
+        # ALTER TABLE на них упадет, поэтому индекс тогда не создается
+        if await self.has_unique_tg_id():
+            return True
+        result = await self.execute_query(
+            "SELECT COUNT(*) AS duplicates FROM "
+            "(SELECT tg_id FROM telegram GROUP BY tg_id HAVING COUNT(*) > 1) AS duplicated",
+            name='create_unique_tg_id'
+        )
+        if result[0]['duplicates']:
+            logger.warning(f"telegram has {result[0]['duplicates']} duplicated tg_id values, "
+                           f"unique index on tg_id is not created")
+            return False
+        
+        await self.execute_update(TELEGRAM_TG_ID_UNIQUE_DDL, name='create_unique_tg_id')
+        self.tg_id_unique = None
+        logger.info(f"Unique index on telegram.tg_id created for server {self.server.name}")
+        return await self.has_unique_tg_id()
+    
+    async def upsert_code(self, tg_id: int, code: int, username: str) -> Optional[UserData]:
+        # Возвращает данные пользователя, если аккаунт уже привязан (код не меняется),
+        # иначе None: код записан в существующую или новую строку
+        if not await self.has_unique_tg_id():
+            user_data = await self.get_user_by_tg_id(tg_id)
+            if user_data and user_data.owner_id != 0:
+                return user_data
+            if user_data:
+                success = await self.update_user_code(tg_id, code, username)
+            else:
+                success = await self.insert_user(tg_id, code, username)
+            if not success:
+                raise Exception("Failed to update database")
+            return None
+        
+        cached, user_data = self.user_cache.lookup(tg_id)
+        if cached and user_data and user_data.owner_id != 0:
+            return user_data
+        
+        # rowcount: 1 - вставлена новая строка, 2 - обновлен код непривязанной строки,
+        # 0 - строка есть, но не изменилась (аккаунт привязан, IF оставил прежний код)
+        async with self.get_cursor(name='upsert_code') as cursor:
+            await cursor.execute(
+                "INSERT INTO telegram (owner_id, tg_id, code, tg_usname) VALUES (0, %s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE "
+                "code = IF(owner_id = 0, VALUES(code), code), "
+                "tg_usname = IF(owner_id = 0, VALUES(tg_usname), tg_usname), "
+                "id = LAST_INSERT_ID(id)",
+                (tg_id, code, username)
+            )
+            self.user_cache.invalidate(tg_id)
+            if cursor.rowcount > 0:
+                return None
+            
+            await cursor.execute(
+                "SELECT id, owner_id, tg_id, code, tg_usname, player_name, type_name FROM telegram WHERE id = %s",
+                (cursor.lastrowid,)
+            )
+            result = await cursor.fetchall()
+        
+        user_data = UserData(**result[0]) if result else None
+        return user_data if user_data and user_data.owner_id != 0 else None
+    
+    async def flush_code_updates(self, batch: Dict[int, tuple]) -> Dict[int, bool]:
+        tg_ids = list(batch)
+        if len(tg_ids) == 1:
+            code, username = batch[tg_ids[0]]
+            result = await self.execute_update(
+                "UPDATE telegram SET code = %s, tg_usname = %s WHERE tg_id = %s",
+                (code, username, tg_ids[0]),
+                name='update_code'
+            )
+            return {tg_ids[0]: result > 0}
+        
+        cases = sql_placeholders(len(tg_ids), "WHEN %s THEN %s", " ")
+        code_params = tuple(value for tg_id in tg_ids for value in (tg_id, batch[tg_id][0]))
+        username_params = tuple(value for tg_id in tg_ids for value in (tg_id, batch[tg_id][1]))
+        
+        async with self.get_cursor(name='update_code_batch') as cursor:
+            await cursor.execute(
+                f"UPDATE telegram SET code = CASE tg_id {cases} END, tg_usname = CASE tg_id {cases} END "
+                f"WHERE tg_id IN ({sql_placeholders(len(tg_ids))})",
+                code_params + username_params + tuple(tg_ids)
+            )
+            if cursor.rowcount >= len(tg_ids):
+                return {tg_id: True for tg_id in tg_ids}
+            
+            # Часть строк не найдена: по одному запросу на той же
+            # сессии выясняем, к каким вызывающим относится результат
+            await cursor.execute(
+                f"SELECT tg_id, code FROM telegram WHERE tg_id IN ({sql_placeholders(len(tg_ids))})",
+                tuple(tg_ids)
+            )
+            codes = {row['tg_id']: row['code'] for row in await cursor.fetchall()}
+            return {tg_id: codes.get(tg_id) == batch[tg_id][0] for tg_id in tg_ids}
+    
+    async def flush_inserts(self, batch: Dict[int, tuple]) -> Dict[int, Any]:
+        tg_ids = list(batch)
+        params = tuple(value for tg_id in tg_ids for value in (tg_id, *batch[tg_id]))
+        
+        try:
+            result = await self.execute_update(
+                f"INSERT INTO telegram (owner_id, tg_id, code, tg_usname) VALUES "
+                f"{sql_placeholders(len(tg_ids), '(0, %s, %s, %s)')}",
+                params,
+                name='insert_user'
+            )
+            return {tg_id: result > 0 for tg_id in tg_ids}
+        except Exception:
+            if len(tg_ids) == 1:
+                raise
+        
+        # Многострочный INSERT откатывается целиком: повторяем по одной строке,
+        # чтобы ошибка досталась только своему вызывающему
+        results = {}
+        for tg_id in tg_ids:
+            try:
+                results.update(await self.flush_inserts({tg_id: batch[tg_id]}))
+            except Exception as e:
+                results[tg_id] = e
+        return results
+    
+    async def flush_deletes(self, batch: Dict[int, tuple]) -> Dict[int, bool]:
+        tg_ids = list(batch)
+        if len(tg_ids) == 1:
+            result = await self.execute_update("DELETE FROM telegram WHERE tg_id = %s", (tg_ids[0],),
+                                               name='delete_user')
+            return {tg_ids[0]: result > 0}
+        
+        in_list = sql_placeholders(len(tg_ids))
+        async with self.get_cursor(name='delete_user_batch') as cursor:
+            await cursor.execute(f"SELECT tg_id FROM telegram WHERE tg_id IN ({in_list})", tuple(tg_ids))
+            existing = {row['tg_id'] for row in await cursor.fetchall()}
+            await cursor.execute(f"DELETE FROM telegram WHERE tg_id IN ({in_list})", tuple(tg_ids))
+        return {tg_id: tg_id in existing for tg_id in tg_ids}
+    
+    async def expire_codes(self, codes: list) -> int:
+        # Обнуляется только тот код, который истек: если игровой сервер уже
+        # записал новый код в строку, он не будет затерт
+        placeholders = sql_placeholders(len(codes), "(%s, %s)")
+        params = tuple(value for pair in codes for value in pair)
+        return await self.execute_update(
+            f"UPDATE telegram SET code = 0 WHERE (id, code) IN ({placeholders})",
+            params,
+            name='expire_codes'
+        )
+    
+    async def update_password(self, player_name: str, new_password: str) -> bool:
+        result = await self.execute_update(
+            f"UPDATE {self.server.accounts_table} SET players_password = %s WHERE name = %s",
+            (new_password, player_name),
+            name='update_password'
+        )
+        return result > 0
+    
+    @staticmethod
+    def shard_filter(column: str, shards: Optional[Set[int]], shard_count: int) -> Tuple[str, tuple]:
+        if shards is None:
+            return "", ()
+        return (f"MOD({column}, %s) IN ({sql_placeholders(len(shards))})",
+                (shard_count, *sorted(shards)))
+    
+    async def iter_telegram_users(self, shards: Optional[Set[int]] = None, shard_count: int = 1,
+                                  chunk_size: int = WARMUP_CHUNK_SIZE):
+        # Серверный курсор на соединении монитора: строки приходят порциями,
+        # таблица целиком в памяти не держится. Соединение занято до конца чтения
+        if shards is not None and not shards:
+            return
+        condition, params = self.shard_filter("id", shards, shard_count)
+        async with self.get_cursor(monitor=True, name='stream_telegram_users',
+                                   cursor_class=aiomysql.SSDictCursor) as cursor:
+            await cursor.execute(
+                "SELECT id, owner_id, tg_id, code, tg_usname, player_name, type_name FROM telegram"
+                + (f" WHERE {condition}" if condition else ""),
+                params
+            )
+            while True:
+                rows = await cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+    
+    async def get_binlog_position(self) -> Optional[Tuple[str, int]]:
+        for statement in ("SHOW BINARY LOG STATUS", "SHOW MASTER STATUS"):
+            try:
+                result = await self.execute_query(statement, monitor=True, name='binlog_position')
+            except aiomysql.ProgrammingError:
+                continue
+            if result:
+                return result[0]['File'], result[0]['Position']
+        return None
+    
+    async def create_change_feed(self):
+        for statement in TELEGRAM_EVENTS_DDL:
+            await self.execute_update(statement, name='create_change_feed')
+    
+    async def has_change_feed(self) -> bool:
+        result = await self.execute_query("SHOW TABLES LIKE 'telegram_events'", monitor=True,
+                                          name='has_change_feed')
+        return bool(result)
+    
+    async def get_feed_watermark(self) -> int:
+        result = await self.execute_query(
+            "SELECT COALESCE(MAX(event_id), 0) AS watermark FROM telegram_events",
+            monitor=True,
+            name='feed_watermark'
+        )
+        return result[0]['watermark']
+    
+    async def get_telegram_changes(self, after_event_id: int, limit: int = FEED_BATCH_SIZE,
+                                   shards: Optional[Set[int]] = None, shard_count: int = 1) -> list:
+        if shards is not None and not shards:
+            return []
+        condition, params = self.shard_filter("e.row_id", shards, shard_count)
+        return await self.execute_query(
+            "SELECT e.event_id, e.row_id, UNIX_TIMESTAMP(e.created_at) AS changed_at, t.id, t.owner_id, t.tg_id, t.code, t.tg_usname, t.player_name, t.type_name "
+            "FROM telegram_events e LEFT JOIN telegram t ON t.id = e.row_id "
+            "WHERE e.event_id > %s" + (f" AND {condition}" if condition else "") +
+            " ORDER BY e.event_id LIMIT %s",
+            (after_event_id, *params, limit),
+            monitor=True,
+            name='get_telegram_changes'
+        )
+    
+    async def prune_telegram_events(self, retention_hours: int = FEED_RETENTION_HOURS) -> int:
+        return await self.execute_update(
+            "DELETE FROM telegram_events WHERE created_at < NOW() - INTERVAL %s HOUR",
+            (retention_hours,),
+            monitor=True,
+            name='prune_telegram_events'
+        )
+
+class BinlogEventSource:
+    
+    def __init__(self, db_config: Dict[str, Any], server_id: int = BINLOG_SERVER_ID,
+                 table: str = 'telegram', stream_factory=None, server_name: str = DEFAULT_SERVER.name):
+        self.db_config = db_config
+        self.server_id = server_id
+        self.server_name = server_name
+        self.table = table
+        self.stream_factory = stream_factory or self.open_stream
+        self.log_file: Optional[str] = None
+        self.log_pos: Optional[int] = None
+        self.stream = None
+    
+    def set_position(self, log_file: str, log_pos: int):
+        self.log_file = log_file
+        self.log_pos = log_pos
+    
+    def open_stream(self):
+        if BinLogStreamReader is None:
+            raise RuntimeError("python-mysql-replication is not installed")
+        
+        return BinLogStreamReader(
+            connection_settings={
+                "host": self.db_config["host"],
+                "port": self.db_config.get("port", 3306),
+                "user": self.db_config["user"],
+                "passwd": self.db_config["password"],
+            },
+            server_id=self.server_id,
+            only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent],
+            only_schemas=[self.db_config["db"]],
+            only_tables=[self.table],
+            blocking=True,
+            resume_stream=self.log_file is not None,
+            log_file=self.log_file,
+            log_pos=self.log_pos,
+        )
+    
+    @staticmethod
+    def rows_from_event(event) -> list:
+        # Имена классов вместо isinstance: так же разбираются записанные фикстуры
+        # без установленной python-mysql-replication
+        event_type = type(event).__name__
+        # Время события в binlog (секунды) - начало отсчета задержки доставки
+        changed_at = getattr(event, 'timestamp', None)
+        changes = []
+        
+        for row in getattr(event, 'rows', ()):
+            if event_type == 'DeleteRowsEvent':
+                changes.append((row['values']['id'], None, changed_at))
+            elif event_type == 'UpdateRowsEvent':
+                values = row['after_values']
+                changes.append((values['id'], {name: values.get(name) for name in USER_FIELDS}, changed_at))
+            elif event_type == 'WriteRowsEvent':
+                values = row['values']
+                changes.append((values['id'], {name: values.get(name) for name in USER_FIELDS}, changed_at))
+        
+        return changes
+    
+    def read_stream(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+        stream = self.stream = self.stream_factory()
+        try:
+            for event in stream:
+                changes = self.rows_from_event(event)
+                log_file = getattr(stream, 'log_file', None)
+                if log_file is not None:
+                    self.set_position(log_file, stream.log_pos)
+                if changes:
+                    loop.call_soon_threadsafe(queue.put_nowait, changes)
+        finally:
+            stream.close()
+            self.stream = None
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+    
+    async def run(self, handler):
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        reader = loop.run_in_executor(None, self.read_stream, loop, queue)
+        
+        try:
+            while True:
+                changes = await queue.get()
+                if changes is None:
+                    break
+                MONITOR_ROWS.inc(len(changes), server=self.server_name, source='binlog')
+                for row_id, values, changed_at in changes:
+                    await handler(row_id, values, changed_at)
+        finally:
+            self.close()
+            await reader
+    
+    def close(self):
+        stream = self.stream
+        if stream is not None:
+            stream.close()
+
+@dataclass(order=True)
+class OutboundMessage:
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    text: str = field(compare=False)
+    kwargs: Dict[str, Any] = field(compare=False)
+    description: str = field(compare=False)
+    created_at: float = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+    # Время изменения строки в БД (wall-clock), если источник его знает
+    changed_at: Optional[float] = field(default=None, compare=False)
+    # Итог доставки: 'sent', 'blocked' или 'failed'; отмененное сообщение не отправляется
+    result: Optional[asyncio.Future] = field(default=None, compare=False)
+
+class NotificationSender:
+    
+    def __init__(self, bot: AsyncTeleBot, workers: int = SEND_WORKERS,
+                 global_rate: float = SEND_GLOBAL_RATE, chat_interval: float = SEND_CHAT_INTERVAL,
+                 broadcast_rate: float = BROADCAST_RATE):
+        self.bot = bot
+        self.workers_count = workers
+        # Лимиты всего бота; процесс берет долю total_rate по числу живых процессов
+        self.total_rate = global_rate
+        self.total_broadcast_rate = broadcast_rate
+        self.global_rate = global_rate
+        self.burst = max(global_rate, 1.0)
+        self.chat_interval = chat_interval
+        self.broadcast_rate = min(broadcast_rate, global_rate)
+        self.peers: Dict[str, int] = {}
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.workers: list = []
+        self.seq = 0
+        self.tokens = float(global_rate)
+        self.tokens_updated = time.monotonic()
+        self.broadcast_bucket = [1.0, time.monotonic()]
+        self.paused_until = 0.0
+        self.chat_next_send: Dict[int, float] = {}
+        self.latencies: deque = deque(maxlen=SEND_LATENCY_WINDOW)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.blocked = 0
+    
+    def start(self):
+        for _ in range(self.workers_count):
+            self.workers.append(asyncio.create_task(self.worker(), name='sender'))
+        logger.info(f"Очередь уведомлений запущена ({self.workers_count} обработчиков, {self.global_rate} сообщений/с)")
+    
+    def set_peers(self, server_name: str, workers: int):
+        # Все процессы отправляют от одного токена: лимит SEND_GLOBAL_RATE делится
+        # между живыми процессами из `telegram_workers` (по серверу с наибольшим числом)
+        self.peers[server_name] = max(workers, 1)
+        peers = max(self.peers.values())
+        global_rate = self.total_rate / peers
+        if global_rate == self.global_rate:
+            return
+        self.global_rate = global_rate
+        self.burst = max(global_rate, 1.0)
+        self.broadcast_rate = min(self.total_broadcast_rate / peers, global_rate)
+        self.tokens = min(self.tokens, self.burst)
+        logger.info(f"Лимит отправки процесса: {global_rate:.1f} сообщений/с ({peers} процессов)")
+    
+    def submit(self, chat_id: int, text: str, priority: int, description: str = "",
+               changed_at: Optional[float] = None, **kwargs) -> asyncio.Future:
+        self.seq += 1
+        result = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(OutboundMessage(
+            priority, self.seq, chat_id, text, kwargs, description, time.monotonic(), changed_at=changed_at,
+            result=result
+        ))
+        return result
+    
+    async def acquire_broadcast(self):
+        # Темп постановки рассылки в очередь; сама отправка все равно идет
+        # через общий лимит и после сообщений с более высоким приоритетом
+        while True:
+            now = time.monotonic()
+            Throttle.refill(self.broadcast_bucket, self.broadcast_rate, 1.0, now)
+            if self.broadcast_bucket[0] >= 1:
+                self.broadcast_bucket[0] -= 1
+                return
+            await asyncio.sleep((1 - self.broadcast_bucket[0]) / self.broadcast_rate)
+    
+    async def wait_pause(self):
+        while time.monotonic() < self.paused_until:
+            await asyncio.sleep(self.paused_until - time.monotonic())
+    
+    async def acquire_global(self):
+        while True:
+            await self.wait_pause()
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.tokens_updated) * self.global_rate)
+            self.tokens_updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.global_rate)
+    
+    async def acquire_chat(self, chat_id: int):
+        # Слот в чате резервируется сразу, поэтому параллельные обработчики
+        # не отправят в один чат чаще, чем раз в chat_interval
+        now = time.monotonic()
+        send_at = max(now, self.chat_next_send.get(chat_id, 0.0))
+        self.chat_next_send[chat_id] = send_at + self.chat_interval
+        
+        if len(self.chat_next_send) > 10000:
+            self.chat_next_send = {cid: t for cid, t in self.chat_next_send.items() if t > now}
+        
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+    
+    @staticmethod
+    def cancelled(message: OutboundMessage) -> bool:
+        return message.result is not None and message.result.cancelled()
+    
+    async def worker(self):
+        # Токен берется после извлечения из очереди: простаивающие обработчики
+        # не держат токены заранее и не превышают лимит всплеском
+        while True:
+            message = await self.queue.get()
+            try:
+                if self.cancelled(message):
+                    continue
+                await self.acquire_global()
+                # Пока обработчик ждал токен, могло прийти сообщение важнее (код
+                # во время рассылки): взятое возвращается в очередь, уходит первое
+                self.queue.put_nowait(message)
+                self.queue.task_done()
+                message = self.queue.get_nowait()
+                if self.cancelled(message):
+                    # Отмененная рассылка: токен возвращается следующему сообщению
+                    self.tokens = min(self.burst, self.tokens + 1)
+                    continue
+                await self.deliver(message)
+            except Exception as e:
+                logger.error(f"❌ Ошибка в очереди уведомлений: {e}")
+                self.resolve(message, 'failed')
+            finally:
+                self.queue.task_done()
+    
+    async def drain(self, timeout: float) -> int:
+        # Ждет отправки очереди не дольше timeout и останавливает обработчики;
+        # возвращает число неотправленных сообщений
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        return self.queue.qsize()
+    
+    @staticmethod
+    def resolve(message: OutboundMessage, outcome: str):
+        if message.result is not None and not message.result.done():
+            message.result.set_result(outcome)
+    
+    async def deliver(self, message: OutboundMessage):
+        await self.acquire_chat(message.chat_id)
+        # Пауза после 429 могла начаться, пока обработчик ждал токен или слот в чате
+        await self.wait_pause()
+        message.attempts += 1
+        
+        try:
+            await self.bot.send_message(message.chat_id, message.text, **message.kwargs)
+        except ApiException as e:
+            record_api_error('sendMessage', e)
+            if getattr(e, 'error_code', None) == 429:
+                retry_after = getattr(e, 'result_json', {}).get('parameters', {}).get('retry_after', 1)
+                self.rate_limited += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                self.tokens = 0.0
+                self.tokens_updated = self.paused_until
+                logger.warning(f"Telegram ограничил отправку (429), пауза {retry_after} с")
+                self.retry(message, count_attempt=False)
+            elif getattr(e, 'error_code', None) == 403:
+                # Пользователь заблокировал бота или удалил чат - повтор бесполезен
+                self.blocked += 1
+                log_sampler.info('blocked', f"Пользователь {message.chat_id} заблокировал бота ({message.description})")
+                self.resolve(message, 'blocked')
+            else:
+                self.failed += 1
+                logger.error(f"❌ Ошибка отправки ({message.description}): {e}")
+                self.resolve(message, 'failed')
+            return
+        except Exception as e:
+            record_api_error('sendMessage', e)
+            if message.attempts < SEND_MAX_ATTEMPTS:
+                delay = SEND_RETRY_DELAY * 2 ** (message.attempts - 1)
+                logger.warning(f"Повтор отправки через {delay:.0f} с ({message.description}): {e}")
+                # Обработчик ждет сам: сообщение остается незавершенным в очереди и drain его дождется
+                await asyncio.sleep(delay)
+                self.retry(message)
+            else:
+                self.failed += 1
+                logger.error(f"❌ Ошибка отправки ({message.description}): {e}")
+                self.resolve(message, 'failed')
+            return
+        
+        self.sent += 1
+        self.resolve(message, 'sent')
+        self.latencies.append(time.monotonic() - message.created_at)
+        if message.changed_at is not None:
+            delivery = max(time.time() - message.changed_at, 0.0)
+        else:
+            delivery = time.monotonic() - message.created_at
+        DELIVERY_LATENCY.observe(delivery, kind=PRIORITY_NAMES.get(message.priority, str(message.priority)))
+        log_sampler.info('sent', f"✅ Отправлено: {message.description}")
+    
+    def retry(self, message: OutboundMessage, count_attempt: bool = True):
+        if not count_attempt:
+            message.attempts -= 1
+        self.retried += 1
+        self.queue.put_nowait(message)
+    
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        return {
+            'queue_depth': self.queue.qsize(),
+            'global_rate': self.global_rate,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rate_limited': self.rate_limited,
+            'blocked': self.blocked,
+            'latency_p50': latencies[len(latencies) // 2] if latencies else 0.0,
+            'latency_p99': latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+            'latency_max': latencies[-1] if latencies else 0.0,
+        }
+
+class UpdateDispatcher:
+    
+    UPDATE_FIELDS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                     'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request')
+    
+    def __init__(self, bot: AsyncTeleBot, lanes: int = DISPATCH_LANES, user_queue: int = DISPATCH_USER_QUEUE):
+        self.bot = bot
+        # Полоса общая для пользователей с одним остатком id, поэтому ее длина не
+        # ограничена: лимит считается по каждому пользователю отдельно
+        self.lanes = [asyncio.Queue() for _ in range(lanes)]
+        self.user_queue = user_queue
+        # ключ пользователя -> обновлений в полосе и в обработке
+        self.pending: Dict[int, int] = {}
+        self.workers: list = []
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+    
+    @classmethod
+    def update_key(cls, update) -> int:
+        for name in cls.UPDATE_FIELDS:
+            event = getattr(update, name, None)
+            if event is not None and getattr(event, 'from_user', None) is not None:
+                return event.from_user.id
+        return update.update_id
+    
+    def submit_nowait(self, update) -> bool:
+        key = self.update_key(update)
+        pending = self.pending.get(key, 0)
+        if pending >= self.user_queue:
+            self.rejected += 1
+            log_sampler.log(logging.WARNING, 'dispatch_flood',
+                            f"У пользователя {key} уже {pending} необработанных обновлений, обновление {update.update_id} отброшено")
+            return False
+        self.pending[key] = pending + 1
+        self.lanes[key % len(self.lanes)].put_nowait(update)
+        return True
+    
+    async def submit(self, update) -> bool:
+        return self.submit_nowait(update)
+    
+    def start(self):
+        for lane in self.lanes:
+            self.workers.append(asyncio.create_task(self.lane_worker(lane), name='dispatch'))
+        logger.info(f"Update dispatcher started with {len(self.lanes)} lanes")
+    
+    async def lane_worker(self, lane: asyncio.Queue):
+        while True:
+            update = await lane.get()
+            self.in_flight += 1
+            try:
+                await self.bot.process_new_updates([update])
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                self.in_flight -= 1
+                self.release(update)
+                lane.task_done()
+    
+    def release(self, update):
+        key = self.update_key(update)
+        pending = self.pending.pop(key, 1) - 1
+        if pending:
+            self.pending[key] = pending
+    
+    async def drain(self):
+        await asyncio.gather(*(lane.join() for lane in self.lanes))
+    
+    async def stop(self):
+        for task in self.workers:
+            task.cancel()
+        self.workers = []
+    
+    def stats(self) -> Dict[str, Any]:
+        depths = [lane.qsize() for lane in self.lanes]
+        return {
+            'in_flight': self.in_flight,
+            'queued': sum(depths),
+            'max_lane_depth': max(depths),
+            'users_queued': len(self.pending),
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+        }
+
+class WebhookServer:
+    
+    # Обновления принимаются HTTP-обработчиком и раскладываются по полосам
+    # диспетчера. Лишнее обновление заваливающего бота пользователя тоже получает
+    # 200: повторная доставка только задержала бы очередь обновлений бота
+    
+    def __init__(self, bot: AsyncTeleBot, dispatcher: UpdateDispatcher, url: str = WEBHOOK_URL,
+                 secret_token: str = WEBHOOK_SECRET, host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.url = url
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.path = path
+        self.runner = None
+        self.received = 0
+        self.rejected = 0
+    
+    async def handle_request(self, request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, self.secret_token):
+            return web.Response(status=403)
+        
+        # Тело без update_id или не JSON-объект - ошибка отправителя, а не сервера
+        try:
+            body = await request.json()
+            if not isinstance(body, dict):
+                raise TypeError("update must be a JSON object")
+            update = types.Update.de_json(body)
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        
+        if not self.dispatcher.submit_nowait(update):
+            self.rejected += 1
+            return web.Response()
+        
+        self.received += 1
+        return web.Response()
+    
+    async def start(self):
+        if web is None:
+            raise RuntimeError("aiohttp is not installed")
+        
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_request)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        
+        if self.url:
+            await self.bot.set_webhook(
+                url=self.url,
+                secret_token=self.secret_token,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        logger.info(f"Webhook server listening on {self.host}:{self.port}{self.path}")
+    
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+        }
+
+class ShardLeaseManager:
+    
+    # Каждый процесс отмечается в `telegram_workers` и держит примерно
+    # shard_count / число живых процессов аренд; аренды умершего процесса истекают
+    # через SHARD_LEASE_TTL и забираются остальными при следующем продлении
+    
+    def __init__(self, db: DatabaseManager, shard_count: int = SHARD_COUNT, worker_id: str = WORKER_ID,
+                 lease_ttl: int = SHARD_LEASE_TTL, renew_interval: int = SHARD_RENEW_INTERVAL):
+        self.db = db
+        self.shard_count = shard_count
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.renew_interval = renew_interval
+        self.owned: Set[int] = set()
+        self.valid_until = 0.0
+        # Живые процессы по последнему продлению аренд
+        self.workers = 1
+    
+    def owns(self, row_id: int) -> bool:
+        return row_id % self.shard_count in self.owned
+    
+    async def initialize(self):
+        for statement in TELEGRAM_SHARDS_DDL:
+            await self.db.execute_update(statement, name='shard_leases')
+        await self.db.execute_update(
+            f"INSERT IGNORE INTO telegram_shard_leases (shard, expires_at) VALUES "
+            f"{sql_placeholders(self.shard_count, '(%s, NOW(3))')}",
+            tuple(range(self.shard_count)),
+            name='shard_leases'
+        )
+    
+    async def fetch_owned(self) -> Set[int]:
+        result = await self.db.execute_query(
+            "SELECT shard FROM telegram_shard_leases WHERE owner = %s AND expires_at > NOW(3) AND shard < %s",
+            (self.worker_id, self.shard_count),
+            name='shard_leases'
+        )
+        return {row['shard'] for row in result}
+    
+    async def rebalance(self) -> Set[int]:
+        db = self.db
+        await db.execute_update(
+            "INSERT INTO telegram_workers (worker_id, seen_at) VALUES (%s, NOW(3)) "
+            "ON DUPLICATE KEY UPDATE seen_at = NOW(3)",
+            (self.worker_id,),
+            name='shard_leases'
+        )
+        result = await db.execute_query(
+            "SELECT COUNT(*) AS workers FROM telegram_workers WHERE seen_at > NOW(3) - INTERVAL %s SECOND",
+            (self.lease_ttl,),
+            name='shard_leases'
+        )
+        self.workers = max(result[0]['workers'], 1)
+        target = -(-self.shard_count // self.workers)
+        
+        await db.execute_update(
+            "UPDATE telegram_shard_leases SET expires_at = NOW(3) + INTERVAL %s SECOND WHERE owner = %s",
+            (self.lease_ttl, self.worker_id),
+            name='shard_leases'
+        )
+        owned = await self.fetch_owned()
+        
+        if len(owned) > target:
+            excess = sorted(owned)[target:]
+            await db.execute_update(
+                f"UPDATE telegram_shard_leases SET owner = '', expires_at = NOW(3) "
+                f"WHERE owner = %s AND shard IN ({sql_placeholders(len(excess))})",
+                (self.worker_id, *excess),
+                name='shard_leases'
+            )
+            owned -= set(excess)
+        elif len(owned) < target:
+            await db.execute_update(
+                "UPDATE telegram_shard_leases SET owner = %s, expires_at = NOW(3) + INTERVAL %s SECOND "
+                "WHERE expires_at <= NOW(3) AND shard < %s ORDER BY shard LIMIT %s",
+                (self.worker_id, self.lease_ttl, self.shard_count, target - len(owned)),
+                name='shard_leases'
+            )
+            owned = await self.fetch_owned()
+        
+        return owned
+    
+    async def refresh(self) -> Tuple[Set[int], Set[int]]:
+        try:
+            owned = await self.rebalance()
+            self.valid_until = time.monotonic() + self.lease_ttl - self.renew_interval
+        except Exception as e:
+            logger.error(f"Не удалось продлить аренду шардов: {e}")
+            if time.monotonic() < self.valid_until:
+                return set(), set()
+            # Аренда могла истечь и перейти к другому процессу: шарды отпускаются,
+            # чтобы два процесса не отправляли одни и те же уведомления
+            owned = set()
+        
+        gained, lost = owned - self.owned, self.owned - owned
+        self.owned = owned
+        return gained, lost
+    
+    async def release(self):
+        await self.db.execute_update(
+            "UPDATE telegram_shard_leases SET owner = '', expires_at = NOW(3) WHERE owner = %s",
+            (self.worker_id,),
+            name='shard_leases'
+        )
+        await self.db.execute_update("DELETE FROM telegram_workers WHERE worker_id = %s", (self.worker_id,),
+                                     name='shard_leases')
+        self.owned = set()
+
+class BroadcastManager:
+    
+    # Рассылки одного сервера. Получатели - привязанные строки `telegram` без
+    # записи в `telegram_blocked`, читаются по возрастанию id порциями. Прогресс
+    # сохраняется в `telegram_broadcasts`: после перезапуска рассылка продолжается
+    # с last_row_id. Рассылку ведет процесс, держащий ее аренду (owner, lease_until)
+    
+    def __init__(self, db: DatabaseManager, worker_id: str = WORKER_ID, lease_ttl: int = BROADCAST_LEASE_TTL,
+                 chunk_size: int = BROADCAST_CHUNK_SIZE, window: int = BROADCAST_WINDOW,
+                 checkpoint_interval: float = BROADCAST_CHECKPOINT_INTERVAL):
+        self.db = db
+        self.server = db.server
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.chunk_size = chunk_size
+        self.window = window
+        self.checkpoint_interval = checkpoint_interval
+        self.sender: Optional[NotificationSender] = None
+        self.initialized = False
+        self.wakeup = asyncio.Event()
+        self.current: Optional[int] = None
+        self.checkpoint_at = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+    
+    async def initialize(self):
+        if not self.initialized:
+            for statement in TELEGRAM_BROADCAST_DDL:
+                await self.db.execute_update(statement, name='broadcast')
+            self.initialized = True
+    
+    async def create(self, text: str, created_by: int) -> int:
+        await self.initialize()
+        async with self.db.get_cursor(name='broadcast') as cursor:
+            await cursor.execute(
+                "INSERT INTO telegram_broadcasts (text, created_by) VALUES (%s, %s)",
+                (text, created_by)
+            )
+            broadcast_id = cursor.lastrowid
+        self.wakeup.set()
+        return broadcast_id
+    
+    async def cancel(self) -> int:
+        await self.initialize()
+        return await self.db.execute_update(
+            "UPDATE telegram_broadcasts SET status = 'cancelled', finished_at = NOW() WHERE status = 'running'",
+            name='broadcast'
+        )
+    
+    async def recent(self, limit: int = 5) -> list:
+        await self.initialize()
+        return await self.db.execute_query(
+            "SELECT id, status, last_row_id, sent, failed, blocked, created_at, finished_at "
+            "FROM telegram_broadcasts ORDER BY id DESC LIMIT %s",
+            (limit,),
+            name='broadcast'
+        )
+    
+    async def claim(self) -> list:
+        # Незавершенные рассылки, аренда которых принадлежит этому процессу или истекла
+        await self.db.execute_update(
+            "UPDATE telegram_broadcasts SET owner = %s, lease_until = NOW(3) + INTERVAL %s SECOND "
+            "WHERE status = 'running' AND (owner = %s OR lease_until < NOW(3))",
+            (self.worker_id, self.lease_ttl, self.worker_id),
+            name='broadcast'
+        )
+        return await self.db.execute_query(
+            "SELECT id, text, created_by, last_row_id, sent, failed, blocked FROM telegram_broadcasts "
+            "WHERE status = 'running' AND owner = %s ORDER BY id",
+            (self.worker_id,),
+            name='broadcast'
+        )
+    
+    async def get_targets(self, after_row_id: int) -> list:
+        return await self.db.execute_query(
+            "SELECT t.id, t.tg_id FROM telegram t "
+            "WHERE t.id > %s AND t.owner_id != 0 "
+            "AND NOT EXISTS (SELECT 1 FROM telegram_blocked b WHERE b.tg_id = t.tg_id) "
+            "ORDER BY t.id LIMIT %s",
+            (after_row_id, self.chunk_size),
+            name='broadcast_targets'
+        )
+    
+    async def checkpoint(self, broadcast: Dict[str, Any], blocked: list, lease_ttl: Optional[int] = None) -> bool:
+        # False - рассылку отменили или ее аренду забрал другой процесс
+        if blocked:
+            await self.db.execute_update(
+                f"INSERT IGNORE INTO telegram_blocked (tg_id) VALUES {sql_placeholders(len(blocked), '(%s)')}",
+                tuple(blocked),
+                name='broadcast'
+            )
+            blocked.clear()
+        result = await self.db.execute_update(
+            "UPDATE telegram_broadcasts SET last_row_id = %s, sent = %s, failed = %s, blocked = %s, "
+            "lease_until = NOW(3) + INTERVAL %s SECOND WHERE id = %s AND owner = %s AND status = 'running'",
+            (broadcast['last_row_id'], broadcast['sent'], broadcast['failed'], broadcast['blocked'],
+             self.lease_ttl if lease_ttl is None else lease_ttl, broadcast['id'], self.worker_id),
+            name='broadcast'
+        )
+        return result > 0
+    
+    async def finish(self, broadcast: Dict[str, Any]):
+        await self.db.execute_update(
+            "UPDATE telegram_broadcasts SET status = 'done', finished_at = NOW() "
+            "WHERE id = %s AND owner = %s AND status = 'running'",
+            (broadcast['id'], self.worker_id),
+            name='broadcast'
+        )
+    
+    def settle(self, broadcast: Dict[str, Any], pending: deque, blocked: list):
+        # last_row_id продвигается только по непрерывному префиксу завершенных
+        # отправок: все строки до него включительно уже обработаны
+        while pending and pending[0][2].done():
+            row_id, tg_id, result = pending.popleft()
+            outcome = 'failed' if result.cancelled() else result.result()
+            broadcast[outcome] += 1
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if outcome == 'blocked':
+                blocked.append(tg_id)
+            broadcast['last_row_id'] = row_id
+    
+    async def drain(self, broadcast: Dict[str, Any], pending: deque, blocked: list, limit: int) -> bool:
+        # Ждет, пока в очереди останется не больше limit сообщений рассылки, и
+        # по пути сохраняет прогресс (и продлевает аренду), даже если отправка стоит на паузе 429
+        while True:
+            self.settle(broadcast, pending, blocked)
+            if time.monotonic() >= self.checkpoint_at:
+                self.checkpoint_at = time.monotonic() + self.checkpoint_interval
+                if not await self.checkpoint(broadcast, blocked):
+                    logger.info(f"[{self.server.name}] Рассылка #{broadcast['id']} остановлена")
+                    return False
+            if len(pending) <= limit:
+                return True
+            await asyncio.wait([pending[0][2]], timeout=self.checkpoint_interval)
+    
+    async def run_broadcast(self, broadcast: Dict[str, Any]):
+        broadcast_id = broadcast['id']
+        self.current = broadcast_id
+        self.checkpoint_at = time.monotonic() + self.checkpoint_interval
+        pending: deque = deque()
+        blocked: list = []
+        after_row_id = broadcast['last_row_id']
+        logger.info(f"[{self.server.name}] Рассылка #{broadcast_id} запущена с id > {after_row_id}")
+        
+        try:
+            while True:
+                rows = await self.get_targets(after_row_id)
+                for row in rows:
+                    await self.sender.acquire_broadcast()
+                    if not await self.drain(broadcast, pending, blocked, self.window - 1):
+                        return
+                    pending.append((row['id'], row['tg_id'], self.sender.submit(
+                        row['tg_id'], broadcast['text'], PRIORITY_BROADCAST, f"рассылка #{broadcast_id} -> {row['tg_id']}"
+                    )))
+                
+                if len(rows) < self.chunk_size:
+                    break
+                after_row_id = rows[-1]['id']
+            
+            if not await self.drain(broadcast, pending, blocked, 0):
+                return
+            if not await self.checkpoint(broadcast, blocked):
+                return
+            await self.finish(broadcast)
+        except asyncio.CancelledError:
+            # Остановка процесса: прогресс сохраняется, аренда отпускается сразу,
+            # и рассылку без ожидания BROADCAST_LEASE_TTL продолжит следующий процесс
+            self.settle(broadcast, pending, blocked)
+            try:
+                await asyncio.wait_for(self.checkpoint(broadcast, blocked, lease_ttl=0), self.checkpoint_interval)
+            except Exception as e:
+                logger.error(f"[{self.server.name}] Не удалось сохранить прогресс рассылки #{broadcast_id}: {e}")
+            raise
+        finally:
+            # Неотправленные сообщения остановленной рассылки убираются из очереди
+            for _, _, result in pending:
+                result.cancel()
+            self.current = None
+        
+        logger.info(f"[{self.server.name}] Рассылка #{broadcast_id} завершена: отправлено {broadcast['sent']}, "
+                    f"ошибок {broadcast['failed']}, заблокировали бота {broadcast['blocked']}")
+        self.sender.submit(
+            broadcast['created_by'],
+            f"📣 Рассылка #{broadcast_id} на сервере {self.server.name} завершена.\n"
+            f"Отправлено: {broadcast['sent']}, ошибок: {broadcast['failed']}, "
+            f"заблокировали бота: {broadcast['blocked']}",
+            PRIORITY_BINDING,
+            f"итог рассылки #{broadcast_id}"
+        )
+    
+    async def run(self, sender: NotificationSender):
+        self.sender = sender
+        while True:
+            try:
+                await self.initialize()
+                for broadcast in await self.claim():
+                    await self.run_broadcast(broadcast)
+            except Exception as e:
+                logger.error(f"[{self.server.name}] Ошибка рассылки: {e}")
+            
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), BROADCAST_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'running': int(self.current is not None),
+            'sent': self.sent,
+            'failed': self.failed,
+            'blocked': self.blocked,
+        }
+
+class StateStore:
+    
+    # Хранилище состояния CodeManager: значения живут ttl секунд (None - бессрочно),
+    # пространства имен разделяют состояния диалога, капчи и активные коды.
+    # Методы - корутины: постоянное хранилище не должно блокировать цикл событий
+    
+    async def get(self, namespace: str, key: Any) -> Optional[Any]:
+        raise NotImplementedError
+    
+    async def set(self, namespace: str, key: Any, value: Any, ttl: Optional[float] = None):
+        raise NotImplementedError
+    
+    async def delete(self, namespace: str, key: Any):
+        raise NotImplementedError
+    
+    def purge_expired(self) -> int:
+        raise NotImplementedError
+    
+    def close(self):
+        pass
+
+class MemoryStateStore(StateStore):
+    
+    def __init__(self):
+        self.entries: Dict[Tuple[str, Any], Tuple[Any, Optional[float]]] = {}
+        self.expiry_heap: list = []
+    
+    async def get(self, namespace: str, key: Any) -> Optional[Any]:
+        entry = self.entries.get((namespace, key))
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self.entries[(namespace, key)]
+            return None
+        return entry[0]
+    
+    async def set(self, namespace: str, key: Any, value: Any, ttl: Optional[float] = None):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        self.entries[(namespace, key)] = (value, expires_at)
+        if expires_at is not None:
+            heapq.heappush(self.expiry_heap, (expires_at, namespace, key))
+        self.purge_expired()
+    
+    async def delete(self, namespace: str, key: Any):
+        self.entries.pop((namespace, key), None)
+    
+    def purge_expired(self) -> int:
+        # Вызывается при каждой записи: брошенные капчи и состояния удаляются
+        # сами, а устаревшие записи кучи (перезаписанные ключи) отбрасываются
+        now = time.monotonic()
+        heap = self.expiry_heap
+        purged = 0
+        while heap and heap[0][0] <= now:
+            expires_at, namespace, key = heapq.heappop(heap)
+            entry = self.entries.get((namespace, key))
+            if entry is not None and entry[1] == expires_at:
+                del self.entries[(namespace, key)]
+                purged += 1
+        
+        if len(heap) > 2 * len(self.entries) + 1024:
+            self.expiry_heap = [(entry[1], namespace, key) for (namespace, key), entry in self.entries.items()
+                                if entry[1] is not None]
+            heapq.heapify(self.expiry_heap)
+        return purged
+
+class SQLiteStateStore(StateStore):
+    
+    # Общее состояние для нескольких процессов бота на одной машине (WAL).
+    # Время истечения хранится в wall-clock, т.к. monotonic у процессов разный.
+    # Запросы к соединению идут в отдельном потоке, по одному: цикл событий не
+    # ждет диск, а запись и удаление одного ключа не обгоняют друг друга
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS bot_state ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_bot_state_expires ON bot_state (expires_at)")
+        self.thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bot-state')
+        self.purged_at = 0.0
+    
+    async def get(self, namespace: str, key: Any) -> Optional[Any]:
+        row = await executors.in_thread(self.read_value, namespace, str(key), time.time(), executor=self.thread)
+        return json.loads(row[0]) if row else None
+    
+    async def set(self, namespace: str, key: Any, value: Any, ttl: Optional[float] = None):
+        now = time.time()
+        await executors.in_thread(self.write_value, namespace, str(key), json.dumps(value),
+                                  None if ttl is None else now + ttl, executor=self.thread)
+        if now - self.purged_at >= STATE_PURGE_INTERVAL:
+            # Очистка может удалить много строк: она идет в пуле потоков на своем соединении
+            self.purged_at = now
+            executors.submit_thread(self.purge_expired, now)
+    
+    async def delete(self, namespace: str, key: Any):
+        await executors.in_thread(self.delete_value, namespace, str(key), executor=self.thread)
+    
+    def read_value(self, namespace: str, key: str, now: float) -> Optional[tuple]:
+        return self.conn.execute(
+            "SELECT value FROM bot_state WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, key, now)
+        ).fetchone()
+    
+    def write_value(self, namespace: str, key: str, value: str, expires_at: Optional[float]):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO bot_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, value, expires_at)
+        )
+    
+    def delete_value(self, namespace: str, key: str):
+        self.conn.execute("DELETE FROM bot_state WHERE namespace = ? AND key = ?", (namespace, key))
+    
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        conn = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+        try:
+            return conn.execute("DELETE FROM bot_state WHERE expires_at <= ?",
+                                (time.time() if now is None else now,)).rowcount
+        finally:
+            conn.close()
+    
+    def close(self):
+        self.thread.shutdown(wait=True)
+        self.conn.close()
+
+class CodeManager:
+    
+    def __init__(self, store: Optional[StateStore] = None, code_namespace: str = 'code'):
+        self.store = store or MemoryStateStore()
+        # У каждого сервера свое пространство имен кодов: id строк `telegram` серверов пересекаются
+        self.code_namespace = code_namespace
+        self.active_codes: Dict[int, CodeInfo] = {}
+        self.expiry_heap: list = []
+        self.expiry_changed = asyncio.Event()
+    
+    def generate_code(self) -> int:
+        return random.randint(100000, 999999)
+    
+    def generate_password(self, length: int = 8) -> str:
+        chars = string.ascii_letters + string.digits
+        while True:
+            password = ''.join(random.choice(chars) for _ in range(length))
+            if (any(c.islower() for c in password) and 
+                any(c.isupper() for c in password) and 
+                any(c.isdigit() for c in password)):
+                return password
+    
+    def generate_captcha(self) -> Tuple[str, str]:
+        num1 = random.randint(1, 10)
+        num2 = random.randint(1, 10)
+        operation = random.choice(['+', '-'])
+        if operation == '+':
+            answer = str(num1 + num2)
+            question = f"{num1} + {num2}"
+        else:
+            answer = str(num1 - num2)
+            question = f"{num1} - {num2}"
+        return question, answer
+    
+    async def add_code(self, code_id: int, tg_id: int, code: int, expiry_minutes: int = 1):
+        await self.schedule_code(code_id, tg_id, code, expiry_minutes * 60)
+    
+    async def restore_code(self, code_id: int, tg_id: int, code: int, expiry_minutes: int = 1):
+        # После перезапуска код получает оставшееся, а не новое время жизни,
+        # если хранилище помнит его срок
+        stored = await self.store.get(self.code_namespace, code_id)
+        if stored and stored['code'] == code:
+            await self.schedule_code(code_id, tg_id, code, max(stored['expires_at'] - time.time(), 0), persist=False)
+        else:
+            await self.add_code(code_id, tg_id, code, expiry_minutes)
+    
+    async def schedule_code(self, code_id: int, tg_id: int, code: int, delay: float, persist: bool = True):
+        # Код попадает в кучу до записи в хранилище: срок отсчитывается с момента выдачи
+        expires_at = time.monotonic() + delay
+        self.active_codes[code_id] = CodeInfo(code, expires_at, tg_id)
+        self.push_expiry(code_id, expires_at)
+        if persist:
+            await self.store.set(self.code_namespace, code_id,
+                                 {'code': code, 'tg_id': tg_id, 'expires_at': time.time() + delay},
+                                 delay + STATE_PURGE_INTERVAL)
+    
+    def push_expiry(self, code_id: int, expires_at: float):
+        # Записи в куче не удаляются при замене/отмене кода, устаревшие
+        # отбрасываются при извлечении; при накоплении куча перестраивается
+        if len(self.expiry_heap) > 2 * len(self.active_codes) + 1024:
+            self.expiry_heap = [(info.expires_at, cid) for cid, info in self.active_codes.items()]
+            heapq.heapify(self.expiry_heap)
+        else:
+            heapq.heappush(self.expiry_heap, (expires_at, code_id))
+        
+        if self.expiry_heap[0] == (expires_at, code_id):
+            self.expiry_changed.set()
+    
+    def next_expiry(self) -> Optional[float]:
+        heap = self.expiry_heap
+        while heap:
+            expires_at, code_id = heap[0]
+            info = self.active_codes.get(code_id)
+            if info is not None and info.expires_at == expires_at:
+                return expires_at
+            heapq.heappop(heap)
+        return None
+    
+    def get_expired_codes(self, now: Optional[float] = None) -> list:
+        now = time.monotonic() if now is None else now
+        expired = []
+        while True:
+            expires_at = self.next_expiry()
+            if expires_at is None or expires_at > now:
+                return expired
+            expired.append(heapq.heappop(self.expiry_heap)[1])
+    
+    async def remove_code(self, code_id: int, code: Optional[int] = None, persist: bool = True):
+        if code is not None:
+            info = self.active_codes.get(code_id)
+            if info is None or info.code != code:
+                return
+        if self.active_codes.pop(code_id, None) is not None and persist:
+            await self.store.delete(self.code_namespace, code_id)
+    
+    async def set_user_state(self, user_id: int, state: str, data: Dict = None):
+        await self.store.set('state', user_id, {'state': state, 'data': data or {}}, USER_STATE_TTL)
+    
+    async def get_user_state(self, user_id: int) -> Optional[Dict]:
+        return await self.store.get('state', user_id)
+    
+    async def clear_user_state(self, user_id: int):
+        await self.store.delete('state', user_id)
+    
+    async def set_captcha(self, user_id: int, answer: str):
+        await self.store.set('captcha', user_id, {'answer': answer, 'attempts': 0}, CAPTCHA_TTL)
+    
+    async def verify_captcha(self, user_id: int, user_answer: str) -> bool:
+        captcha_data = await self.store.get('captcha', user_id)
+        if captcha_data is None:
+            return False
+        
+        captcha_data['attempts'] += 1
+        
+        if user_answer.strip() == captcha_data['answer']:
+            await self.store.delete('captcha', user_id)
+            return True
+        
+        await self.store.set('captcha', user_id, captcha_data, CAPTCHA_TTL)
+        return False
+    
+    async def get_captcha_attempts(self, user_id: int) -> int:
+        captcha_data = await self.store.get('captcha', user_id)
+        return captcha_data['attempts'] if captcha_data else 0
+    
+    async def remove_captcha(self, user_id: int):
+        await self.store.delete('captcha', user_id)
+
+class LoopProfiler:
+    
+    # Задержка цикла событий: корутина засыпает на interval и замеряет, насколько
+    # позже проснулась. Сторож в отдельном потоке видит, что пульс не обновлялся
+    # дольше threshold, и снимает стек потока цикла, пока тот еще занят; когда
+    # цикл освобождается, остановка пишется в лог с цепочкой корутин-виновников.
+    # В метрике остановка подписывается именем задачи asyncio, а у безымянных
+    # задач - самой глубокой корутиной цепочки
+    
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = SLOW_CALLBACK_THRESHOLD,
+                 watchdog: bool = PROFILE_ENABLED, profile_dir: str = PROFILE_DIR):
+        self.threshold = threshold
+        self.watchdog = watchdog
+        # Сторожу нужен пульс чаще порога, иначе обычный сон выглядит как зависание
+        self.interval = min(interval, threshold / 2) if watchdog else interval
+        self.profile_dir = profile_dir
+        self.beat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        # (задача, корутины, стек), снятые сторожем во время текущей остановки
+        self.stall: Optional[Tuple[str, str, str]] = None
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.profile: Optional[cProfile.Profile] = None
+        self.profile_timer: Optional[asyncio.TimerHandle] = None
+    
+    async def sample_lag(self):
+        self.loop_thread_id = threading.get_ident()
+        self.loop = asyncio.get_running_loop()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.beat = now
+            lag = max(now - expected, 0.0)
+            LOOP_LAG.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            
+            stall, self.stall = self.stall, None
+            if stall is not None:
+                self.report(stall, lag)
+    
+    def start_watchdog(self):
+        if self.watchdog and self.thread is None:
+            self.beat = time.monotonic()
+            self.thread = threading.Thread(target=self.watch, name='loop-watchdog', daemon=True)
+            self.thread.start()
+            logger.info(f"Сторож цикла событий запущен (порог {self.threshold * 1000:.0f} мс)")
+    
+    def stop(self):
+        self.stopped.set()
+        self.finish_profile()
+    
+    def watch(self):
+        while not self.stopped.wait(self.threshold / 2):
+            if self.loop_thread_id is None or self.stall is not None:
+                continue
+            if time.monotonic() - self.beat - self.interval > self.threshold:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    self.stall = self.describe(frame, asyncio.current_task(self.loop))
+    
+    @staticmethod
+    def describe(frame, task: Optional[asyncio.Task] = None) -> Tuple[str, str, str]:
+        # Цепочка корутин от задачи к месту блокировки; если корутин в стеке нет
+        # (обычный callback), виновником считается самая глубокая функция
+        stack = ''.join(traceback.format_stack(frame, limit=STALL_STACK_LIMIT))
+        innermost = getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+        coroutines = []
+        while frame is not None:
+            if frame.f_code.co_flags & (inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR):
+                coroutines.append(getattr(frame.f_code, 'co_qualname', frame.f_code.co_name))
+            frame = frame.f_back
+        if coroutines:
+            innermost = coroutines[0]
+        
+        # Имена вида Task-123 раздает asyncio, в метку они не годятся
+        name = task.get_name() if task is not None else ''
+        label = innermost if not name or re.fullmatch(r'Task-\d+', name) else name
+        return label, ' -> '.join(reversed(coroutines)) or innermost, stack
+    
+    def report(self, stall: Tuple[str, str, str], lag: float):
+        label, coroutines, stack = stall
+        self.stalls += 1
+        LOOP_STALLS.inc(task=label)
+        logger.warning(f"Цикл событий заблокирован на {lag * 1000:.0f} мс в {label}: {coroutines}\n{stack}")
+    
+    def dump_path(self, kind: str, suffix: str) -> str:
+        return os.path.join(self.profile_dir, f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.{suffix}")
+    
+    def dump_stacks(self):
+        # SIGUSR1: стеки всех задач asyncio и всех потоков; файл пишется вне цикла
+        parts = []
+        for task in asyncio.all_tasks():
+            buffer = io.StringIO()
+            task.print_stack(limit=STALL_STACK_LIMIT, file=buffer)
+            parts.append(f"{task.get_name()}: {buffer.getvalue()}")
+        for thread_id, frame in sys._current_frames().items():
+            parts.append(f"Thread {thread_id}:\n{''.join(traceback.format_stack(frame, limit=STALL_STACK_LIMIT))}")
+        
+        path = self.dump_path('stacks', 'txt')
+        executors.submit_thread(self.write_file, path, '\n'.join(parts))
+        logger.info(f"Стеки {len(parts)} задач и потоков сохраняются в {path}")
+    
+    @staticmethod
+    def write_file(path: str, text: str):
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(text)
+    
+    def toggle_profile(self):
+        # SIGUSR2: cProfile цикла событий на PROFILE_DURATION секунд,
+        # повторный сигнал завершает замер раньше
+        if self.profile is not None:
+            self.finish_profile()
+            return
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.profile_timer = asyncio.get_running_loop().call_later(PROFILE_DURATION, self.finish_profile)
+        logger.info(f"Профилирование запущено на {PROFILE_DURATION} с")
+    
+    def finish_profile(self):
+        profile, self.profile = self.profile, None
+        if profile is None:
+            return
+        profile.disable()
+        if self.profile_timer is not None:
+            self.profile_timer.cancel()
+            self.profile_timer = None
+        
+        executors.submit_thread(self.save_profile, profile, self.dump_path('profile', 'prof'))
+    
+    @staticmethod
+    def save_profile(profile: cProfile.Profile, path: str):
+        profile.dump_stats(path)
+        buffer = io.StringIO()
+        pstats.Stats(profile, stream=buffer).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        logger.info(f"Профиль сохранен в {path}\n{buffer.getvalue()}")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'max_lag': self.max_lag,
+            'stalls': self.stalls,
+            'watchdog': int(self.thread is not None),
+            'profiling': int(self.profile is not None),
+        }
+
+class TaskSupervisor:
+    
+    # Фоновые задачи процесса под именами. Упавшая задача перезапускается с
+    # задержкой, удваивающейся от base_delay до max_delay; задача, проработавшая
+    # stable_after секунд, снова начинает с base_delay. Задача, завершившаяся
+    # без ошибки (прогрев), не перезапускается
+    
+    def __init__(self, base_delay: float = SUPERVISOR_BASE_DELAY, max_delay: float = SUPERVISOR_MAX_DELAY,
+                 stable_after: float = SUPERVISOR_STABLE_AFTER):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.restarts = 0
+    
+    def spawn(self, name: str, factory):
+        # factory создает корутину заново при каждом перезапуске
+        if name in self.tasks and not self.tasks[name].done():
+            raise ValueError(f"Task {name} is already running")
+        self.tasks[name] = asyncio.create_task(self.supervise(name, factory), name=name)
+    
+    async def supervise(self, name: str, factory):
+        failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                await factory()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if time.monotonic() - started >= self.stable_after:
+                    failures = 0
+                delay = min(self.base_delay * 2 ** failures, self.max_delay) * random.uniform(0.8, 1.2)
+                failures += 1
+                self.restarts += 1
+                TASK_RESTARTS.inc(task=name)
+                logger.error(f"Фоновая задача {name} упала: {e!r}, перезапуск через {delay:.1f} с", exc_info=e)
+                await asyncio.sleep(delay)
+    
+    async def stop(self, prefix: str = '', timeout: Optional[float] = None):
+        # Отменяет задачи, имена которых начинаются с prefix, и ждет их завершения
+        tasks = [task for name, task in self.tasks.items() if name.startswith(prefix)]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        self.tasks = {name: task for name, task in self.tasks.items() if not task.done()}
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'running': sum(not task.done() for task in self.tasks.values()),
+            'restarts': self.restarts,
+        }
+
+class ServerMonitor:
+    
+    # Снимок, лента изменений, коды и шарды одного игрового сервера. Бот держит
+    # по монитору на сервер, все они работают на одном цикле событий и
+    # отправляют уведомления через общий NotificationSender
+    
+    def __init__(self, db: DatabaseManager, codes: Optional[CodeManager] = None,
+                 binlog_source: Optional[BinlogEventSource] = None,
+                 shard_leases: Optional[ShardLeaseManager] = None):
+        self.server = db.server
+        self.db = db
+        self.codes = codes or CodeManager(code_namespace=f"code:{self.server.name}")
+        self.binlog = binlog_source
+        self.shards = shard_leases
+        if shard_leases is not None:
+            self.db.user_cache.owns = shard_leases.owns
+        self.broadcasts = BroadcastManager(db)
+        self.sender: Optional[NotificationSender] = None
+        self.snapshot = TelegramSnapshot()
+        self.feed_watermark: Optional[int] = None
+        self.feed_pruned_at = 0.0
+        # Снимок загружается в фоне; обработчики команд работают с БД напрямую
+        # и не ждут его, монитор и обслуживание шардов стартуют после прогрева
+        self.warmed_up = asyncio.Event()
+        self.warmup_seconds = 0.0
+    
+    def start(self, sender: NotificationSender, supervisor: TaskSupervisor, stagger: float = 0.0):
+        self.sender = sender
+        name = self.server.name
+        supervisor.spawn(f"{name}:warm_up", self.warm_up)
+        supervisor.spawn(f"{name}:monitor", lambda: self.monitor_telegram_table(stagger))
+        supervisor.spawn(f"{name}:expiry", self.check_expired_codes)
+        if self.shards is not None:
+            supervisor.spawn(f"{name}:shards", self.maintain_shards)
+        # Рассылки создают только администраторы: без BOT_ADMIN_IDS таблицы
+        # рассылок не создаются и не опрашиваются
+        if ADMIN_IDS:
+            supervisor.spawn(f"{name}:broadcasts", lambda: self.broadcasts.run(sender))
+    
+    async def flush_expirations(self, until: float):
+        # Остановка процесса: коды, срок которых наступит до until (monotonic),
+        # обнуляются сейчас, чтобы не остаться действующими в MySQL без монитора
+        expired_ids = self.codes.get_expired_codes(until)
+        if expired_ids:
+            await self.expire_codes(expired_ids)
+        return len(expired_ids)
+    
+    def expiry_overdue(self) -> float:
+        next_expiry = self.codes.next_expiry()
+        return 0.0 if next_expiry is None else max(time.monotonic() - next_expiry, 0.0)
+    
+    async def monitor_telegram_table(self, stagger: float = 0.0):
+        await self.warmed_up.wait()
+        if self.binlog is not None:
+            await self.follow_binlog()
+        
+        logger.info(f"[{self.server.name}] Запущен мониторинг таблицы `telegram`")
+        
+        # Опросы серверов сдвинуты друг относительно друга на долю интервала,
+        # чтобы сканирования не совпадали по времени на одном цикле событий
+        await asyncio.sleep(stagger)
+        while True:
+            try:
+                with MONITOR_TICK.time(server=self.server.name,
+                                       source='full_scan' if self.feed_watermark is None else 'feed'):
+                    if self.feed_watermark is None:
+                        await self.poll_full_table()
+                    else:
+                        while await self.poll_change_feed() >= FEED_BATCH_SIZE:
+                            pass
+                        await self.prune_change_feed()
+                
+                log_sampler.flush()
+                await asyncio.sleep(MONITOR_INTERVAL)
+            
+            except Exception as e:
+                logger.error(f"[{self.server.name}] Ошибка в мониторе: {e}")
+                await asyncio.sleep(10)
+    
+    async def follow_binlog(self):
+        logger.info(f"[{self.server.name}] Запущено чтение binlog для таблицы `telegram`")
+        failures = 0
+        
+        while failures < BINLOG_MAX_RETRIES:
+            try:
+                await self.binlog.run(self.apply_change)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logger.error(f"[{self.server.name}] Ошибка чтения binlog ({failures}/{BINLOG_MAX_RETRIES}): {e}")
+            await asyncio.sleep(min(2 ** failures, 30))
+        
+        # Позиция binlog потеряна или недоступна: снимок мог устареть, поэтому
+        # опрос начинается с полного сканирования
+        logger.warning(f"[{self.server.name}] Чтение binlog остановлено, переход на опрос таблицы")
+        self.binlog = None
+        self.feed_watermark = None
+    
+    def owned_shards(self) -> Tuple[Optional[Set[int]], int]:
+        if self.shards is None:
+            return None, 1
+        return self.shards.owned, self.shards.shard_count
+    
+    async def apply_change(self, row_id: int, values: Optional[Dict[str, Any]],
+                           changed_at: Optional[float] = None):
+        if self.shards is not None and not self.shards.owns(row_id):
+            return
+        if values is None:
+            await self.forget_user(row_id)
+        else:
+            await self.apply_row(values, changed_at)
+    
+    async def apply_row(self, row: Dict[str, Any], changed_at: Optional[float] = None):
+        changed, old_data = self.snapshot.apply_row(row)
+        if changed:
+            await self.handle_row_change(row['id'], old_data, changed_at)
+    
+    async def handle_row_change(self, user_id: int, old_data: Optional[UserData],
+                                changed_at: Optional[float] = None):
+        user_data = self.snapshot.get(user_id)
+        self.db.user_cache.refresh(user_data)
+        
+        if old_data is None:
+            return
+        
+        if (old_data.code != user_data.code and user_data.code != 0):
+            await self.handle_code_change(user_id, user_data, old_data, changed_at)
+        
+        if (old_data.owner_id == 0 and user_data.owner_id != 0):
+            await self.handle_account_binding(user_id, user_data, changed_at)
+    
+    async def forget_user(self, user_id: int):
+        user_data = self.snapshot.remove(user_id)
+        if user_data is not None:
+            self.db.user_cache.invalidate(user_data.tg_id)
+        await self.codes.remove_code(user_id)
+    
+    async def poll_full_table(self):
+        # Пока ленты нет, проверяем, не появилась ли она: водяной знак берется до
+        # полного скана, поэтому изменения во время скана будут перечитаны из ленты
+        watermark = None
+        if await self.db.has_change_feed():
+            watermark = await self.db.get_feed_watermark()
+        
+        # Скан читается порциями, между ними цикл событий обслуживает обработчики
+        if len(self.snapshot) >= DIFF_OFFLOAD_ROWS:
+            changes, removed_ids, scanned = await self.diff_offloaded()
+        else:
+            current_data = []
+            async with aclosing(self.db.iter_telegram_users(*self.owned_shards())) as chunks:
+                async for chunk in chunks:
+                    current_data.extend(chunk)
+            scanned = len(current_data)
+            changes, removed_ids = self.snapshot.sync(current_data)
+            del current_data
+        MONITOR_ROWS.inc(scanned, server=self.server.name, source='full_scan')
+        
+        for user_id, old_data in changes:
+            await self.handle_row_change(user_id, old_data)
+        
+        for user_id in removed_ids:
+            await self.forget_user(user_id)
+        
+        if watermark is not None:
+            self.feed_watermark = watermark
+            logger.info(f"[{self.server.name}] Лента изменений `telegram_events` найдена, переход на инкрементальный режим (event_id {watermark})")
+    
+    async def diff_offloaded(self) -> Tuple[list, list, int]:
+        # Большой снимок: снимок раскладывается по частям в пуле потоков,
+        # пока читается скан; порции скана сразу раскладываются по тем же частям
+        # и не хранятся как словари. Части сравниваются в пуле процессов, в цикл
+        # событий возвращаются только индексы измененных строк. Снимок мог
+        # измениться за время сравнения, поэтому apply_row сверяет их заново
+        parts = -(-len(self.snapshot) // DIFF_PARTITION_ROWS)
+        snapshot_task = asyncio.ensure_future(
+            executors.in_thread(partition_snapshot, self.snapshot.columns, parts)
+        )
+        scan_parts = new_partitions(parts)
+        scanned = 0
+        try:
+            async with aclosing(self.db.iter_telegram_users(*self.owned_shards())) as chunks:
+                async for chunk in chunks:
+                    partition_rows(chunk, scan_parts)
+                    scanned += len(chunk)
+        finally:
+            snapshot_parts = await snapshot_task
+        
+        async def diff(index: int):
+            return index, await executors.in_process(diff_partition, snapshot_parts[index], scan_parts[index])
+        
+        changes = []
+        removed_ids = []
+        for next_result in asyncio.as_completed([diff(index) for index in range(parts)]):
+            index, (changed_indexes, removed) = await next_result
+            for i in changed_indexes:
+                row = partition_row(scan_parts[index], i)
+                changed, old_data = self.snapshot.apply_row(row)
+                if changed:
+                    changes.append((row['id'], old_data))
+            removed_ids.extend(removed)
+            snapshot_parts[index] = scan_parts[index] = None
+        return changes, removed_ids, scanned
+    
+    async def poll_change_feed(self) -> int:
+        # Перечитываем небольшой хвост уже обработанных событий: AUTO_INCREMENT
+        # выдается до коммита, и событие с меньшим id может появиться позже.
+        # Повторное применение строки безопасно, т.к. сравнение идет со снимком.
+        shards, _ = self.owned_shards()
+        if shards is not None and not shards:
+            # Без шардов снимок пуст, водяной знак просто догоняет ленту
+            self.feed_watermark = await self.db.get_feed_watermark()
+            return 0
+        
+        try:
+            rows = await self.db.get_telegram_changes(
+                max(self.feed_watermark - FEED_OVERLAP, 0), FEED_BATCH_SIZE, *self.owned_shards()
+            )
+        except aiomysql.ProgrammingError as e:
+            logger.warning(f"[{self.server.name}] Лента изменений недоступна ({e}), возврат к полному сканированию")
+            self.feed_watermark = None
+            return 0
+        
+        MONITOR_ROWS.inc(len(rows), server=self.server.name, source='feed')
+        latest_rows = {}
+        for row in rows:
+            latest_rows[row.pop('row_id')] = row
+            self.feed_watermark = max(self.feed_watermark, row.pop('event_id'))
+        
+        for row_id, row in latest_rows.items():
+            changed_at = row.pop('changed_at')
+            await self.apply_change(row_id, row if row['id'] is not None else None,
+                                    float(changed_at) if changed_at is not None else None)
+        
+        return len(rows)
+    
+    async def prune_change_feed(self):
+        now = time.monotonic()
+        if now - self.feed_pruned_at < FEED_PRUNE_INTERVAL:
+            return
+        
+        self.feed_pruned_at = now
+        deleted = await self.db.prune_telegram_events()
+        if deleted:
+            logger.info(f"[{self.server.name}] Удалено старых событий из `telegram_events`: {deleted}")
+    
+    async def handle_code_change(self, user_id: int, new_data: UserData, old_data: UserData,
+                                 changed_at: Optional[float] = None):
+        log_sampler.info('code_change', f"[{self.server.name}] Обнаружено изменение кода для id {user_id}: {old_data.code} -> {new_data.code}")
+        
+        await self.codes.add_code(user_id, new_data.tg_id, new_data.code)
+        log_sampler.info('code_change', f"[{self.server.name}] Код {new_data.code} будет активен 1 минуту")
+        
+        if new_data.owner_id != 0:
+            try:
+                markup = types.InlineKeyboardMarkup()
+                markup.add(types.InlineKeyboardButton(text='Перейти в поддержку', url='t.me/fl1ckyy'))
+                
+                player_name = new_data.player_name.replace('_', ' ') if new_data.player_name else "Неизвестный"
+                
+                # Если type_name пустое или None, то пишем "Неизвестный тип"
+                action_name = new_data.type_name if new_data.type_name else "Неизвестный тип"
+                
+                message_text = (
+                    f"⚠️ С Вашего аккаунта *{player_name}* на *{self.server.name}* сервере поступил запрос на выполнение действия "
+                    f"«{action_name}». *Код подтверждения: {new_data.code}*\n\n"
+                    f"Никому не передавайте этот код! Даже администрации проекта. "
+                    f"Если Вы не запрашивали это действие, обратитесь в техническую поддержку."
+                )
+                
+                self.sender.submit(
+                    new_data.tg_id, 
+                    message_text, 
+                    PRIORITY_CODE,
+                    description=f"код {new_data.code} пользователю {new_data.tg_id} (ID: {user_id})",
+                    changed_at=changed_at,
+                    parse_mode='Markdown', 
+                    reply_markup=markup
+                )
+            
+            except Exception as e:
+                logger.error(f"[{self.server.name}] ❌ Ошибка отправки кода пользователю {new_data.tg_id}: {e}")
+        else:
+            log_sampler.info('code_unbound', f"[{self.server.name}] ⏸️ Аккаунт не привязан (owner_id=0), код не отправлен")
+    
+    async def handle_account_binding(self, user_id: int, data: UserData, changed_at: Optional[float] = None):
+        log_sampler.info('binding', f"[{self.server.name}] Обнаружена привязка аккаунта для ID {user_id}: 0 -> {data.owner_id}")
+        
+        try:
+            player_name = data.player_name.replace('_', ' ') if data.player_name else "Неизвестный"
+            message_text = f"✅ Аккаунт {player_name} на {self.server.name} сервере *успешно привязан* к Телеграм помощнику."
+            
+            self.sender.submit(
+                data.tg_id,
+                message_text,
+                PRIORITY_BINDING,
+                description=f"уведомление о привязке пользователю {data.tg_id} (ID: {user_id})",
+                changed_at=changed_at,
+                parse_mode='Markdown'
+            )
+        
+        except Exception as e:
+            logger.error(f"[{self.server.name}] ❌ Ошибка отправки уведомления о привязке: {e}")
+    
+    async def check_expired_codes(self):
+        logger.info(f"[{self.server.name}] Запущен мониторинг просроченных кодов")
+        
+        while True:
+            try:
+                self.codes.expiry_changed.clear()
+                next_expiry = self.codes.next_expiry()
+                timeout = None if next_expiry is None else max(next_expiry - time.monotonic(), 0)
+                
+                try:
+                    await asyncio.wait_for(self.codes.expiry_changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                
+                expired_ids = self.codes.get_expired_codes()
+                if expired_ids:
+                    await self.expire_codes(expired_ids)
+            
+            except Exception as e:
+                logger.error(f"[{self.server.name}] Ошибка в мониторе просроченных кодов: {e}")
+                await asyncio.sleep(10)
+    
+    async def expire_codes(self, code_ids: list):
+        expired = [(code_id, self.codes.active_codes[code_id]) for code_id in code_ids
+                   if code_id in self.codes.active_codes]
+        
+        for start in range(0, len(expired), EXPIRE_BATCH_SIZE):
+            batch = expired[start:start + EXPIRE_BATCH_SIZE]
+            try:
+                updated = await self.db.expire_codes([(code_id, info.code) for code_id, info in batch])
+            except Exception as e:
+                logger.error(f"[{self.server.name}] ❌ Ошибка при обнулении кодов (ID: {[code_id for code_id, _ in batch]}): {e}")
+                for code_id, info in batch:
+                    if self.codes.active_codes.get(code_id) is info:
+                        await self.codes.schedule_code(code_id, info.tg_id, info.code, EXPIRE_RETRY_DELAY)
+                continue
+            
+            for code_id, info in batch:
+                await self.codes.remove_code(code_id, info.code)
+                if self.snapshot.set_code(code_id, 0, expected=info.code):
+                    self.db.user_cache.refresh(self.snapshot.get(code_id))
+            
+            logger.info(f"[{self.server.name}] 🔄 Обнулено кодов: {updated} из {len(batch)} (истек срок действия)")
     
-    async def initialize(self):
+    async def init_monitor(self):
         try:
-            self.pool = await aiomysql.create_pool(**self.db_config)
-            logger.info("Database connection pool initialized")
+            if self.binlog is not None:
+                # Позиция фиксируется до загрузки снимка: изменения во время загрузки
+                # будут прочитаны из binlog повторно, применение строки идемпотентно
+                position = await self.db.get_binlog_position()
+                if position:
+                    self.binlog.set_position(*position)
+                    logger.info(f"[{self.server.name}] Чтение binlog начнется с позиции {position[0]}:{position[1]}")
+                else:
+                    logger.warning(f"[{self.server.name}] binlog недоступен (нужны log_bin и REPLICATION CLIENT), используется опрос таблицы")
+                    self.binlog = None
+            
+            # Водяной знак берется до загрузки снимка, но фиксируется только после
+            # нее: если загрузка прервется, монитор начнет с полного сканирования
+            watermark = None
+            if await self.db.has_change_feed():
+                watermark = await self.db.get_feed_watermark()
+            else:
+                logger.info(f"[{self.server.name}] Лента изменений `telegram_events` не найдена, используется полное сканирование")
+            
+            if self.shards is not None:
+                await self.shards.initialize()
+                await self.shards.refresh()
+                self.sender.set_peers(self.server.name, self.shards.workers)
+                logger.info(f"[{self.server.name}] Процесс {self.shards.worker_id} владеет шардами {sorted(self.shards.owned)} из {self.shards.shard_count}")
+            
+            await self.load_snapshot(*self.owned_shards())
+            
+            if watermark is not None:
+                self.feed_watermark = watermark
+                logger.info(f"[{self.server.name}] Используется лента изменений `telegram_events` (event_id {watermark})")
+            
+            logger.info(f"[{self.server.name}] ✅ Загружено записей: {len(self.snapshot)}")
+            logger.info(f"[{self.server.name}] Активных кодов: {len(self.codes.active_codes)}")
+        
         except Exception as e:
-            logger.error(f"Failed to initialize database pool: {e}")
+            # Снимок загружен не полностью: строки, которых в нем нет, при первом
+            # изменении выглядели бы новыми и не дали бы уведомлений. Прогрев
+            # повторит супервизор, снимок загружается заново
+            logger.error(f"[{self.server.name}] ❌ Ошибка инициализации монитора: {e}")
+            self.snapshot = TelegramSnapshot()
             raise
     
-    @asynccontextmanager
-    async def get_cursor(self):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cursor:
-                try:
-                    yield cursor
-                finally:
-                    await cursor.close()
-    
-    async def execute_query(self, query: str, params: tuple = None) -> Any:
-        async with self.get_cursor() as cursor:
-            await cursor.execute(query, params or ())
-            return await cursor.fetchall()
-    
-    async def execute_update(self, query: str, params: tuple = None) -> int:
-        async with self.get_cursor() as cursor:
-            await cursor.execute(query, params or ())
-            return cursor.rowcount
-    
-    async def get_user_by_tg_id(self, tg_id: int) -> Optional[UserData]:
-        result = await self.execute_query(
-            "SELECT id, owner_id, tg_id, code, tg_usname, player_name, type_name FROM telegram WHERE tg_id = %s",
-            (tg_id,)
-        )
-        return UserData(**result[0]) if result else None
-    
-    async def update_user_code(self, tg_id: int, code: int, username: str) -> bool:
-        result = await self.execute_update(
-            "UPDATE telegram SET code = %s, tg_usname = %s WHERE tg_id = %s",
-            (code, username, tg_id)
-        )
-        return result > 0
-    
-    async def insert_user(self, tg_id: int, code: int, username: str) -> bool:
-        result = await self.execute_update(
-            "INSERT INTO telegram (owner_id, tg_id, code, tg_usname) VALUES (0, %s, %s, %s)",
-            (tg_id, code, username)
-        )
-        return result > 0
+    async def load_snapshot(self, shards: Optional[Set[int]] = None, shard_count: int = 1):
+        if shards is not None and not shards:
+            return
+        
+        restored = 0
+        
+        async with aclosing(self.db.iter_telegram_users(shards, shard_count)) as chunks:
+            async for chunk in chunks:
+                MONITOR_ROWS.inc(len(chunk), server=self.server.name, source='warmup')
+                for user_row in chunk:
+                    self.snapshot.apply_row(user_row)
+                    
+                    if user_row['code']:
+                        await self.codes.restore_code(user_row['id'], user_row['tg_id'], user_row['code'])
+                        log_sampler.info('restore_code', f"[{self.server.name}] Восстановлен код {user_row['code']} для ID {user_row['id']}")
+                        restored += 1
+                # Без постоянного хранилища порция разбирается без переключений: отдаем цикл обработчикам
+                await asyncio.sleep(0)
+        
+        log_sampler.flush(force=True)
+        if restored:
+            logger.info(f"[{self.server.name}] Восстановлено кодов: {restored}")
     
-    async def delete_user(self, tg_id: int) -> bool:
-        result = await self.execute_update(
-            "DELETE FROM telegram WHERE tg_id = %s",
-            (tg_id,)
-        )
-        return result > 0
+    async def drop_shards(self, shards: Set[int]):
+        # Коды из хранилища не удаляются: новый владелец шарда восстановит их срок
+        shard_count = self.shards.shard_count
+        for row_id in [row_id for row_id in self.snapshot.ids if row_id % shard_count in shards]:
+            user_data = self.snapshot.remove(row_id)
+            # Изменения этих строк больше не приходят в монитор процесса
+            self.db.user_cache.invalidate(user_data.tg_id)
+            await self.codes.remove_code(row_id, persist=False)
     
-    async def update_password(self, player_name: str, new_password: str) -> bool:
-        result = await self.execute_update(
-            "UPDATE accounts_1101 SET players_password = %s WHERE name = %s",
-            (new_password, player_name)
-        )
-        return result > 0
+    async def maintain_shards(self):
+        await self.warmed_up.wait()
+        while True:
+            await asyncio.sleep(self.shards.renew_interval)
+            try:
+                gained, lost = await self.shards.refresh()
+                self.sender.set_peers(self.server.name, self.shards.workers)
+                
+                if lost:
+                    await self.drop_shards(lost)
+                    logger.info(f"[{self.server.name}] Шарды {sorted(lost)} переданы другим процессам")
+                if gained:
+                    await self.load_snapshot(gained, self.shards.shard_count)
+                    logger.info(f"[{self.server.name}] Получены шарды {sorted(gained)}, записей в снимке: {len(self.snapshot)}")
+            
+            except Exception as e:
+                logger.error(f"[{self.server.name}] Ошибка обслуживания шардов: {e}")
     
-    async def get_all_telegram_users(self) -> list:
-        return await self.execute_query(
-            "SELECT id, owner_id, tg_id, code, tg_usname, player_name, type_name FROM telegram"
-        )
+    async def warm_up(self):
+        # Монитор и обслуживание шардов ждут только полностью загруженного снимка
+        started = time.monotonic()
+        await self.init_monitor()
+        self.warmup_seconds = time.monotonic() - started
+        self.warmed_up.set()
+        logger.info(f"[{self.server.name}] Прогрев завершен за {self.warmup_seconds:.1f} с")
 
-class CodeManager:
-    
-    def __init__(self):
-        self.active_codes: Dict[int, CodeInfo] = {}
-        self.user_states: Dict[int, Dict[str, Any]] = {}
-        self.captcha_attempts: Dict[int, Dict[str, Any]] = {}
-    
-    def generate_code(self) -> int:
-        return random.randint(100000, 999999)
+class TelegramBot:
     
-    def generate_password(self, length: int = 8) -> str:
-        chars = string.ascii_letters + string.digits
-        while True:
-            password = ''.join(random.choice(chars) for _ in range(length))
-            if (any(c.islower() for c in password) and 
-                any(c.isupper() for c in password) and 
-                any(c.isdigit() for c in password)):
-                return password
+    def __init__(self, token: str, servers: list, code_manager: CodeManager, poll_updates: bool = True,
+                 update_mode: str = 'polling'):
+        self.bot = AsyncTeleBot(token)
+        # Имя сервера -> ServerMonitor; первый сервер используется по умолчанию
+        self.servers: Dict[str, ServerMonitor] = {monitor.server.name: monitor for monitor in servers}
+        self.codes = code_manager
+        self.poll_updates = poll_updates
+        self.dispatcher = UpdateDispatcher(self.bot)
+        self.webhook = WebhookServer(self.bot, self.dispatcher) if update_mode == 'webhook' else None
+        self.sender = NotificationSender(self.bot)
+        self.supervisor = TaskSupervisor()
+        self.profiler = LoopProfiler()
+        self.code_requests: Dict[Tuple[int, str], asyncio.Future] = {}
+        self.throttle = Throttle()
+        self.setup_handlers()
+        self.setup_metrics()
     
-    def generate_captcha(self) -> Tuple[str, str]:
-        num1 = random.randint(1, 10)
-        num2 = random.randint(1, 10)
-        operation = random.choice(['+', '-'])
-        if operation == '+':
-            answer = str(num1 + num2)
-            question = f"{num1} + {num2}"
-        else:
-            answer = str(num1 - num2)
-            question = f"{num1} - {num2}"
-        return question, answer
+    def per_server(self, stat) -> Dict[str, Any]:
+        return {name: stat(monitor) for name, monitor in self.servers.items()}
     
-    def add_code(self, code_id: int, tg_id: int, code: int, expiry_minutes: int = 1):
-        expiry_time = datetime.now() + timedelta(minutes=expiry_minutes)
-        self.active_codes[code_id] = CodeInfo(code, expiry_time, tg_id)
+    def per_server_stats(self, stats) -> Dict[Tuple[str, str], Any]:
+        return {(name, key): value for name, monitor in self.servers.items()
+                for key, value in stats(monitor).items()}
     
-    def get_expired_codes(self) -> list:
-        now = datetime.now()
-        return [code_id for code_id, info in self.active_codes.items() 
-                if now >= info.expiry_time]
+    def setup_metrics(self):
+        # Gauge с callback читают stats() компонентов в момент запроса /metrics
+        server_stat = ('server', 'stat')
+        metrics.gauge('bot_sender', 'Notification queue stats', self.sender.stats)
+        metrics.gauge('bot_db_pool', 'MySQL pool stats',
+                      lambda: self.per_server_stats(lambda monitor: monitor.db.pool_stats()), server_stat)
+        metrics.gauge('bot_user_cache', 'tg_id lookup cache stats',
+                      lambda: self.per_server_stats(lambda monitor: monitor.db.user_cache.stats()), server_stat)
+        metrics.gauge('bot_dispatcher', 'Update dispatcher stats', self.dispatcher.stats)
+        if self.webhook is not None:
+            metrics.gauge('bot_webhook', 'Webhook server stats', self.webhook.stats)
+        metrics.gauge('bot_snapshot_rows', 'Rows in the monitor snapshot',
+                      lambda: self.per_server(lambda monitor: len(monitor.snapshot)), ('server',))
+        metrics.gauge('bot_active_codes', 'Codes waiting for expiry',
+                      lambda: self.per_server(lambda monitor: len(monitor.codes.active_codes)), ('server',))
+        metrics.gauge('bot_expiry_overdue_seconds', 'How late the earliest pending expiry is',
+                      lambda: self.per_server(ServerMonitor.expiry_overdue), ('server',))
+        metrics.gauge('bot_code_requests_in_flight', 'Code requests being issued', lambda: len(self.code_requests))
+        metrics.gauge('bot_throttle', 'Throttling stats', self.throttle.stats)
+        metrics.gauge('bot_tasks', 'Supervised background tasks', self.supervisor.stats)
+        metrics.gauge('bot_event_loop', 'Event loop lag and profiler state', self.profiler.stats)
+        metrics.gauge('bot_executors', 'Thread and process pool usage', executors.stats)
+        metrics.gauge('bot_warmup_done', 'Whether the startup snapshot load has finished',
+                      lambda: self.per_server(lambda monitor: int(monitor.warmed_up.is_set())), ('server',))
+        metrics.gauge('bot_broadcast', 'Broadcast progress',
+                      lambda: self.per_server_stats(lambda monitor: monitor.broadcasts.stats()), server_stat)
+        metrics.gauge('bot_warmup_seconds', 'Duration of the startup snapshot load',
+                      lambda: self.per_server(lambda monitor: monitor.warmup_seconds), ('server',))
     
-    def remove_code(self, code_id: int):
-        self.active_codes.pop(code_id, None)
+    def resolve_server(self, name: str) -> Optional[ServerMonitor]:
+        # Кнопки без имени сервера (одиночный режим и старые сообщения) относятся
+        # к единственному серверу; при нескольких серверах нужно выбрать
+        if name:
+            return self.servers.get(name)
+        if len(self.servers) == 1:
+            return next(iter(self.servers.values()))
+        return None
     
-    def set_user_state(self, user_id: int, state: str, data: Dict = None):
-        self.user_states[user_id] = {'state': state, 'data': data or {}}
+    async def choose_server(self, chat_id: int, action: str, text: str):
+        markup = types.InlineKeyboardMarkup()
+        for name in self.servers:
+            markup.add(types.InlineKeyboardButton(text=f"Сервер {name}", callback_data=f"{action}:{name}"))
+        await self.bot.send_message(chat_id, text, reply_markup=markup)
     
-    def get_user_state(self, user_id: int) -> Optional[Dict]:
-        return self.user_states.get(user_id)
+    def timed(self, label: str, handler):
+        async def wrapper(message):
+            await self.run_timed(label, handler, message)
+        return wrapper
     
-    def clear_user_state(self, user_id: int):
-        self.user_states.pop(user_id, None)
+    async def run_timed(self, label: str, handler, *args):
+        with HANDLER_LATENCY.time(handler=label):
+            try:
+                await handler(*args)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=label)
+                raise
     
-    def set_captcha(self, user_id: int, answer: str):
-        self.captcha_attempts[user_id] = {'answer': answer, 'attempts': 0}
+    def setup_handlers(self):
+        self.bot.message_handler(commands=['start'])(self.timed('command:start', self.start_command))
+        self.bot.message_handler(commands=['addcode'])(self.timed('command:addcode', self.addcode_command))
+        self.bot.message_handler(commands=['recovery_password'])(
+            self.timed('command:recovery_password', self.recovery_password_command)
+        )
+        self.bot.message_handler(commands=['broadcast'])(self.timed('command:broadcast', self.broadcast_command))
+        self.bot.message_handler(commands=['broadcast_status'])(
+            self.timed('command:broadcast_status', self.broadcast_status_command)
+        )
+        self.bot.message_handler(commands=['broadcast_stop'])(
+            self.timed('command:broadcast_stop', self.broadcast_stop_command)
+        )
+        
+        
+        # callback_data имеет вид "действие" или "действие:аргумент"; действие
+        # ищется в словаре, а не перебором фильтров
+        self.callback_routes = {
+            'start_recovery': self.start_recovery,
+            'deltg': self.handle_deltg_callback,
+            'addcode': self.handle_addcode_callback,
+            'confirm_deltg': self.handle_confirm_deltg,
+            'cancel_deltg': self.handle_cancel_deltg,
+            'broadcast': self.handle_broadcast_callback,
+        }
+        # Текстовые сообщения вне команд направляются по состоянию диалога пользователя
+        self.state_routes = {
+            'waiting_captcha': self.handle_captcha_answer,
+        }
+        
+        self.bot.callback_query_handler(func=lambda call: True)(self.route_callback)
+        self.bot.message_handler(content_types=['text'])(self.route_message)
     
-    def verify_captcha(self, user_id: int, user_answer: str) -> bool:
-        if user_id not in self.captcha_attempts:
+    async def throttled(self, message_or_call, action: str) -> bool:
+        # Проверка до любого обращения к БД; превышение лимита отвечает
+        # пользователю не чаще лимита 'notice'
+        user_id = message_or_call.from_user.id
+        retry_after = self.throttle.check(user_id, action)
+        if not retry_after:
             return False
         
-        captcha_data = self.captcha_attempts[user_id]
-        captcha_data['attempts'] += 1
-        
-        if user_answer.strip() == captcha_data['answer']:
-            self.captcha_attempts.pop(user_id, None)
+        if self.throttle.check(user_id, 'notice', use_global=False):
             return True
-        return False
-    
-    def get_captcha_attempts(self, user_id: int) -> int:
-        return self.captcha_attempts.get(user_id, {}).get('attempts', 0)
-    
-    def remove_captcha(self, user_id: int):
-        self.captcha_attempts.pop(user_id, None)
-
-class TelegramBot:
+        text = f"⏳ Слишком много запросов. Попробуйте через {math.ceil(retry_after)} с."
+        is_callback = hasattr(message_or_call, 'message')
+        try:
+            if is_callback:
+                await self.bot.answer_callback_query(message_or_call.id, text)
+            else:
+                await self.bot.send_message(message_or_call.chat.id, text)
+        except ApiException as e:
+            record_api_error('answerCallbackQuery' if is_callback else 'sendMessage', e)
+        return True
     
-    def __init__(self, token: str, db_manager: DatabaseManager, code_manager: CodeManager):
-        self.bot = AsyncTeleBot(token)
-        self.db = db_manager
-        self.codes = code_manager
-        self.last_user_data: Dict[int, UserData] = {}
-        self.setup_handlers()
+    async def route_callback(self, call):
+        action, _, arg = (call.data or '').partition(':')
+        handler = self.callback_routes.get(action)
+        if handler is not None:
+            await self.run_timed(f'callback:{action}', handler, call, arg)
     
-    def setup_handlers(self):
-        self.bot.message_handler(commands=['start'])(self.start_command)
-        self.bot.message_handler(commands=['addcode'])(self.addcode_command)
-        self.bot.message_handler(commands=['recovery_password'])(self.recovery_password_command)
-        
-        self.bot.callback_query_handler(func=lambda call: call.data == 'start_recovery')(self.start_recovery)
-        self.bot.callback_query_handler(func=lambda call: call.data == 'deltg')(self.handle_deltg_callback)
-        self.bot.callback_query_handler(func=lambda call: call.data == 'addcode')(self.handle_addcode_callback)
-        self.bot.callback_query_handler(func=lambda call: call.data == 'confirm_deltg')(self.handle_confirm_deltg)
-        self.bot.callback_query_handler(func=lambda call: call.data == 'cancel_deltg')(self.handle_cancel_deltg)
-        
-        self.bot.message_handler(func=lambda message: self.codes.get_user_state(message.from_user.id) and self.codes.get_user_state(message.from_user.id)['state'] == 'waiting_captcha')(self.handle_captcha_answer)
+    async def route_message(self, message):
+        user_state = await self.codes.get_user_state(message.from_user.id)
+        if user_state is None:
+            return
+        handler = self.state_routes.get(user_state['state'])
+        if handler is not None:
+            await self.run_timed(f"state:{user_state['state']}", handler, message, user_state)
     
     async def start_command(self, message):
         markup = types.InlineKeyboardMarkup()
@@ -228,9 +3348,31 @@ class TelegramBot:
         )
     
     async def addcode_command(self, message):
-        await self.process_code_request(message)
+        server = self.resolve_server('')
+        if server is None:
+            await self.choose_server(message.chat.id, 'addcode', "Выберите сервер, аккаунт на котором хотите привязать:")
+            return
+        await self.process_code_request(message, server)
     
-    async def process_code_request(self, message_or_call):
+    async def process_code_request(self, message_or_call, server: ServerMonitor):
+        # Повторные нажатия во время выдачи кода не создают второй запрос к БД:
+        # они дожидаются текущего, ответ пользователю отправит первый запрос
+        key = (message_or_call.from_user.id, server.server.name)
+        in_flight = self.code_requests.get(key)
+        if in_flight is not None:
+            await in_flight
+            return
+        
+        if await self.throttled(message_or_call, 'addcode'):
+            return
+        
+        self.code_requests[key] = asyncio.get_running_loop().create_future()
+        try:
+            await self.issue_code(message_or_call, server)
+        finally:
+            self.code_requests.pop(key).set_result(None)
+    
+    async def issue_code(self, message_or_call, server: ServerMonitor):
         if hasattr(message_or_call, 'message'):
             chat_id = message_or_call.message.chat.id
             user_id = message_or_call.from_user.id
@@ -241,6 +3383,7 @@ class TelegramBot:
                     reply_markup=None
                 )
             except ApiException as e:
+                record_api_error('editMessageReplyMarkup', e)
                 logger.warning(f"Could not edit message: {e}")
         else:
             chat_id = message_or_call.chat.id
@@ -250,43 +3393,36 @@ class TelegramBot:
         code = self.codes.generate_code()
         
         try:
-            user_data = await self.db.get_user_by_tg_id(user_id)
+            user_data = await server.db.upsert_code(user_id, code, username)
             
-            if user_data and user_data.owner_id != 0:
+            if user_data:
                 markup = types.InlineKeyboardMarkup()
-                markup.add(types.InlineKeyboardButton(text='🗑 Отвязать профиль', callback_data='deltg'))
+                markup.add(types.InlineKeyboardButton(text='🗑 Отвязать профиль',
+                                                      callback_data=f"deltg:{server.server.name}"))
                 
                 player_name_display = (user_data.player_name or "Неизвестный").replace('_', ' ')
                 await self.bot.send_message(
                     chat_id,
-                    f"ℹ️ Вы уже <b>привязали</b> свой игровой аккаунт: <b>{player_name_display}</b> на <b>01</b> сервере.\n\n"
+                    f"ℹ️ Вы уже <b>привязали</b> свой игровой аккаунт: <b>{player_name_display}</b> на <b>{server.server.name}</b> сервере.\n\n"
                     f"🔐 Если Вы желаете <b>отвязать</b> свой профиль, нажмите кнопку ниже 🗑",
                     parse_mode='HTML', 
                     reply_markup=markup
                 )
                 return
             
-            if user_data:
-                success = await self.db.update_user_code(user_id, code, username)
-            else:
-                success = await self.db.insert_user(user_id, code, username)
+            log_sampler.info('generated_code', f"Generated code {code} for user {user_id} on server {server.server.name}")
             
-            if success:
-                logger.info(f"Generated code {code} for user {user_id}")
-                
-                await self.bot.send_message(
-                    chat_id,
-                    f"✅ Ваш проверочный код - <b>{code}</b>\n\n"
-                    "1. Выполните вход в свой игровой аккаунт, который желаете привязать.\n"
-                    "2. В меню персонажа (/mn) выберите пункт настройки.\n"
-                    "3. В настройках выберите пункт «Привязать Telegram».\n"
-                    "4. Введите проверочный код и нажмите на кнопку «Подтвердить».\n"
-                    "5. Переключите уведомления c Почты на Telegram.\n\n"
-                    "Если вы привязали аккаунт корректно, то помощник пришел сообщение об успешной привязке.",
-                    parse_mode='HTML'
-                )
-            else:
-                raise Exception("Failed to update database")
+            await self.bot.send_message(
+                chat_id,
+                f"✅ Ваш проверочный код - <b>{code}</b>\n\n"
+                "1. Выполните вход в свой игровой аккаунт, который желаете привязать.\n"
+                "2. В меню персонажа (/mn) выберите пункт настройки.\n"
+                "3. В настройках выберите пункт «Привязать Telegram».\n"
+                "4. Введите проверочный код и нажмите на кнопку «Подтвердить».\n"
+                "5. Переключите уведомления c Почты на Telegram.\n\n"
+                "Если вы привязали аккаунт корректно, то помощник пришел сообщение об успешной привязке.",
+                parse_mode='HTML'
+            )
                 
         except Exception as e:
             logger.error(f"Error processing code request: {e}")
@@ -297,7 +3433,12 @@ class TelegramBot:
     
     async def recovery_password_command(self, message):
         markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton(text='🔓 Восстановить доступ', callback_data='start_recovery'))
+        if len(self.servers) == 1:
+            markup.add(types.InlineKeyboardButton(text='🔓 Восстановить доступ', callback_data='start_recovery'))
+        else:
+            for name in self.servers:
+                markup.add(types.InlineKeyboardButton(text=f'🔓 Восстановить доступ (сервер {name})',
+                                                      callback_data=f"start_recovery:{name}"))
         markup.add(types.InlineKeyboardButton(text='📞 Перейти в поддержку', url='t.me/fl1ckyy'))
 
         await self.bot.send_message(
@@ -309,9 +3450,17 @@ class TelegramBot:
             parse_mode='Markdown'
         )
     
-    async def start_recovery(self, call):
+    async def start_recovery(self, call, arg: str = ''):
+        server = self.resolve_server(arg)
+        if server is None:
+            await self.choose_server(call.message.chat.id, 'start_recovery', "Выберите сервер для восстановления доступа:")
+            return
+        
+        if await self.throttled(call, 'recovery'):
+            return
+        
         try:
-            user_data = await self.db.get_user_by_tg_id(call.from_user.id)
+            user_data = await server.db.get_user_by_tg_id(call.from_user.id)
             
             if not user_data or user_data.owner_id == 0:
                 markup = types.InlineKeyboardMarkup()
@@ -326,14 +3475,14 @@ class TelegramBot:
                 return
             
             new_password = self.codes.generate_password()
-            success = await self.db.update_password(user_data.player_name, new_password)
+            success = await server.db.update_password(user_data.player_name, new_password)
             
             if success:
                 player_name_display = user_data.player_name.replace('_', ' ') if user_data.player_name else "Неизвестный"
                 
                 await self.bot.send_message(
                     call.message.chat.id,
-                    f"✅ Доступ к игровому аккаунту <b>{player_name_display}</b> на <b>01</b> сервере восстановлен!\n"
+                    f"✅ Доступ к игровому аккаунту <b>{player_name_display}</b> на <b>{server.server.name}</b> сервере восстановлен!\n"
                     f"🔑 Ваш новый пароль: <tg-spoiler><b><i>{new_password}</i></b></tg-spoiler>\n\n"
                     f"💾 Не забудьте <b>сохранить пароль</b> в надежном месте!",
                     parse_mode='HTML'
@@ -346,6 +3495,7 @@ class TelegramBot:
                         reply_markup=None
                     )
                 except ApiException as e:
+                    record_api_error('editMessageReplyMarkup', e)
                     logger.warning(f"Could not edit message: {e}")
             else:
                 raise Exception("Password update failed")
@@ -358,11 +3508,19 @@ class TelegramBot:
                 "Пожалуйста, попробуйте позже или обратитесь в поддержку."
             )
     
-    async def handle_deltg_callback(self, call):
+    async def handle_deltg_callback(self, call, arg: str = ''):
+        server = self.resolve_server(arg)
+        if server is None:
+            await self.choose_server(call.message.chat.id, 'deltg', "Выберите сервер, аккаунт на котором хотите отвязать:")
+            return
+        
+        if await self.throttled(call, 'captcha'):
+            return
+        
         try:
             question, answer = self.codes.generate_captcha()
-            self.codes.set_captcha(call.from_user.id, answer)
-            self.codes.set_user_state(call.from_user.id, 'waiting_captcha')
+            await self.codes.set_captcha(call.from_user.id, answer)
+            await self.codes.set_user_state(call.from_user.id, 'waiting_captcha', {'server': server.server.name})
             
             markup = types.InlineKeyboardMarkup()
             markup.add(
@@ -385,21 +3543,21 @@ class TelegramBot:
             logger.error(f"Error starting deltg process: {e}")
             await self.bot.answer_callback_query(call.id, "❌ Произошла ошибка")
     
-    async def handle_captcha_answer(self, message):
+    async def handle_captcha_answer(self, message, user_state: Dict[str, Any]):
         user_id = message.from_user.id
-        user_state = self.codes.get_user_state(user_id)
-        
-        if not user_state or user_state['state'] != 'waiting_captcha':
+        if await self.throttled(message, 'captcha_answer'):
             return
         
-        if self.codes.verify_captcha(user_id, message.text):
-            self.codes.clear_user_state(user_id)
-            await self.process_deltg_confirmation(user_id, message.chat.id)
+        if await self.codes.verify_captcha(user_id, message.text):
+            await self.codes.clear_user_state(user_id)
+            server = self.resolve_server(user_state['data'].get('server', ''))
+            if server is not None:
+                await self.process_deltg_confirmation(user_id, message.chat.id, server)
         else:
-            attempts = self.codes.get_captcha_attempts(user_id)
+            attempts = await self.codes.get_captcha_attempts(user_id)
             if attempts >= 3:
-                self.codes.remove_captcha(user_id)
-                self.codes.clear_user_state(user_id)
+                await self.codes.remove_captcha(user_id)
+                await self.codes.clear_user_state(user_id)
                 await self.bot.send_message(
                     message.chat.id,
                     "❌ Слишком много неверных попыток. Отвязка профиля отменена."
@@ -410,13 +3568,14 @@ class TelegramBot:
                     f"❌ Неверный ответ. Попробуйте еще раз. Попытка {attempts}/3"
                 )
     
-    async def process_deltg_confirmation(self, user_id: int, chat_id: int):
+    async def process_deltg_confirmation(self, user_id: int, chat_id: int, server: ServerMonitor):
         try:
-            success = await self.db.delete_user(user_id)
+            success = await server.db.delete_user(user_id)
             
             if success:
                 markup = types.InlineKeyboardMarkup()
-                markup.add(types.InlineKeyboardButton(text='🔐 Привязать новый аккаунт', callback_data='addcode'))
+                markup.add(types.InlineKeyboardButton(text='🔐 Привязать новый аккаунт',
+                                                      callback_data=f"addcode:{server.server.name}"))
                 
                 await self.bot.send_message(
                     chat_id,
@@ -426,7 +3585,7 @@ class TelegramBot:
                     reply_markup=markup
                 )
                 
-                logger.info(f"Profile unlinked for user {user_id}")
+                logger.info(f"Profile unlinked for user {user_id} on server {server.server.name}")
             else:
                 raise Exception("Failed to delete user")
                 
@@ -434,12 +3593,12 @@ class TelegramBot:
             logger.error(f"Error unlinking profile: {e}")
             await self.bot.send_message(chat_id, "❌ Произошла ошибка при отвязке профиля")
     
-    async def handle_confirm_deltg(self, call):
+    async def handle_confirm_deltg(self, call, arg: str = ''):
         await self.bot.answer_callback_query(call.id, "✍️ Отправьте ответ числом в чат")
     
-    async def handle_cancel_deltg(self, call):
-        self.codes.remove_captcha(call.from_user.id)
-        self.codes.clear_user_state(call.from_user.id)
+    async def handle_cancel_deltg(self, call, arg: str = ''):
+        await self.codes.remove_captcha(call.from_user.id)
+        await self.codes.clear_user_state(call.from_user.id)
         
         try:
             await self.bot.edit_message_text(
@@ -449,174 +3608,221 @@ class TelegramBot:
                 reply_markup=None
             )
         except ApiException as e:
+            record_api_error('editMessageText', e)
             logger.warning(f"Could not edit message: {e}")
     
-    async def handle_addcode_callback(self, call):
-        await self.process_code_request(call)
+    async def handle_addcode_callback(self, call, arg: str = ''):
+        server = self.resolve_server(arg)
+        if server is None:
+            await self.choose_server(call.message.chat.id, 'addcode', "Выберите сервер, аккаунт на котором хотите привязать:")
+            return
+        await self.process_code_request(call, server)
     
-    async def monitor_telegram_table(self):
-        logger.info("Запущен мониторинг таблицы `telegram`")
+    async def broadcast_command(self, message):
+        if message.from_user.id not in ADMIN_IDS:
+            return
+        text = (message.text or '').partition(' ')[2].strip()
+        if not text:
+            await self.bot.send_message(message.chat.id, "Использование: /broadcast <текст рассылки>")
+            return
         
-        while True:
-            try:
-                current_data = await self.db.get_all_telegram_users()
-                current_users = {
-                    row['id']: UserData(**row) for row in current_data
-                }
-                
-                for user_id, user_data in current_users.items():
-                    if user_id in self.last_user_data:
-                        old_data = self.last_user_data[user_id]
-                        
-                        if (old_data.code != user_data.code and user_data.code != 0):
-                            await self.handle_code_change(user_id, user_data, old_data)
-                        
-                        if (old_data.owner_id == 0 and user_data.owner_id != 0):
-                            await self.handle_account_binding(user_id, user_data)
-                
-                self.last_user_data = current_users.copy()
-                
-                expired_ids = set(self.last_user_data.keys()) - set(current_users.keys())
-                for user_id in expired_ids:
-                    self.last_user_data.pop(user_id, None)
-                    self.codes.remove_code(user_id)
-                
-                await asyncio.sleep(3)
-                
-            except Exception as e:
-                logger.error(f"Ошибка в мониторе: {e}")
-                await asyncio.sleep(10)
+        server = self.resolve_server('')
+        if server is None:
+            # Текст ждет выбора сервера в состоянии диалога
+            await self.codes.set_user_state(message.from_user.id, 'broadcast_server', {'text': text})
+            await self.choose_server(message.chat.id, 'broadcast', "Выберите сервер для рассылки:")
+            return
+        await self.start_broadcast(message.chat.id, message.from_user.id, server, text)
     
-    async def handle_code_change(self, user_id: int, new_data: UserData, old_data: UserData):
-        logger.info(f"Обнаружено изменение кода для id {user_id}: {old_data.code} -> {new_data.code}")
-        
-        self.codes.add_code(user_id, new_data.tg_id, new_data.code)
-        logger.info(f"Код {new_data.code} будет активен 1 минуту")
-        
-        if new_data.owner_id != 0:
-            try:
-                markup = types.InlineKeyboardMarkup()
-                markup.add(types.InlineKeyboardButton(text='Перейти в поддержку', url='t.me/fl1ckyy'))
-                
-                player_name = new_data.player_name.replace('_', ' ') if new_data.player_name else "Неизвестный"
-                
-                # Если type_name пустое или None, то пишем "Неизвестный тип"
-                action_name = new_data.type_name if new_data.type_name else "Неизвестный тип"
-                
-                message_text = (
-                    f"⚠️ С Вашего аккаунта *{player_name}* на *01* сервере поступил запрос на выполнение действия "
-                    f"«{action_name}». *Код подтверждения: {new_data.code}*\n\n"
-                    f"Никому не передавайте этот код! Даже администрации проекта. "
-                    f"Если Вы не запрашивали это действие, обратитесь в техническую поддержку."
-                )
-                
-                await self.bot.send_message(
-                    new_data.tg_id, 
-                    message_text, 
-                    parse_mode='Markdown', 
-                    reply_markup=markup
-                )
-                
-                logger.info(f"✅ Отправлен код {new_data.code} пользователю {new_data.tg_id} (ID: {user_id})")
-                
-            except Exception as e:
-                logger.error(f"❌ Ошибка отправки кода пользователю {new_data.tg_id}: {e}")
-        else:
-            logger.info(f"⏸️ Аккаунт не привязан (owner_id=0), код не отправлен")
+    async def handle_broadcast_callback(self, call, arg: str = ''):
+        if call.from_user.id not in ADMIN_IDS:
+            return
+        user_state = await self.codes.get_user_state(call.from_user.id)
+        server = self.resolve_server(arg)
+        if server is None or user_state is None or user_state['state'] != 'broadcast_server':
+            return
+        await self.codes.clear_user_state(call.from_user.id)
+        await self.start_broadcast(call.message.chat.id, call.from_user.id, server, user_state['data']['text'])
     
-    async def handle_account_binding(self, user_id: int, data: UserData):
-        logger.info(f"Обнаружена привязка аккаунта для ID {user_id}: 0 -> {data.owner_id}")
-        
+    async def start_broadcast(self, chat_id: int, admin_id: int, server: ServerMonitor, text: str):
         try:
-            player_name = data.player_name.replace('_', ' ') if data.player_name else "Неизвестный"
-            message_text = f"✅ Аккаунт {player_name} на 01 сервере *успешно привязан* к Телеграм помощнику."
-            
-            await self.bot.send_message(data.tg_id, message_text, parse_mode='Markdown')
-            logger.info(f"✅ Уведомление о привязке отправлено пользователю {data.tg_id} (ID: {user_id})")
-            
+            broadcast_id = await server.broadcasts.create(text, admin_id)
         except Exception as e:
-            logger.error(f"❌ Ошибка отправки уведомления о привязке: {e}")
-    
-    async def check_expired_codes(self):
-        logger.info("Запущен мониторинг просроченных кодов")
+            logger.error(f"Error creating broadcast on server {server.server.name}: {e}")
+            await self.bot.send_message(chat_id, "❌ Не удалось создать рассылку.")
+            return
         
-        while True:
+        logger.info(f"Admin {admin_id} started broadcast #{broadcast_id} on server {server.server.name}")
+        await self.bot.send_message(
+            chat_id,
+            f"📣 Рассылка #{broadcast_id} на сервере {server.server.name} поставлена в очередь.\n"
+            f"Прогресс: /broadcast_status, остановить: /broadcast_stop"
+        )
+    
+    async def broadcast_status_command(self, message):
+        if message.from_user.id not in ADMIN_IDS:
+            return
+        lines = []
+        for name, monitor in self.servers.items():
             try:
-                expired_ids = self.codes.get_expired_codes()
-                
-                for code_id in expired_ids:
-                    await self.expire_code(code_id)
-                
-                await asyncio.sleep(5)
-                
+                broadcasts = await monitor.broadcasts.recent()
             except Exception as e:
-                logger.error(f"Ошибка в мониторе просроченных кодов: {e}")
-                await asyncio.sleep(10)
-    
-    async def expire_code(self, code_id: int):
-        try:
-            success = await self.db.execute_update(
-                "UPDATE telegram SET code = 0 WHERE id = %s", 
-                (code_id,)
-            )
-            
-            if success:
-                logger.info(f"🔄 Код (ID: {code_id}) обнулен (истек срок действия)")
-                self.codes.remove_code(code_id)
-                
-                if code_id in self.last_user_data:
-                    self.last_user_data[code_id].code = 0
-            else:
-                logger.warning(f"Не удалось обнулить код для ID {code_id}")
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка при обнулении кода для ID {code_id}: {e}")
+                logger.error(f"Error reading broadcasts of server {name}: {e}")
+                lines.append(f"Сервер {name}: ошибка чтения")
+                continue
+            for broadcast in broadcasts:
+                lines.append(f"Сервер {name}, #{broadcast['id']} ({broadcast['status']}): отправлено {broadcast['sent']}, "
+                             f"ошибок {broadcast['failed']}, заблокировали бота {broadcast['blocked']}")
+        await self.bot.send_message(message.chat.id, "\n".join(lines) or "Рассылок нет.")
     
-    async def init_monitor(self):
-        try:
-            users_data = await self.db.get_all_telegram_users()
-            
-            for user_row in users_data:
-                user_data = UserData(**user_row)
-                self.last_user_data[user_data.id] = user_data
-                
-                if user_data.code != 0:
-                    self.codes.add_code(user_data.id, user_data.tg_id, user_data.code)
-                    logger.info(f"Восстановлен код {user_data.code} для ID {user_data.id}")
-            
-            logger.info(f"✅ Загружено записей: {len(self.last_user_data)}")
-            logger.info(f"Активных кодов: {len(self.codes.active_codes)}")
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка инициализации монитора: {e}")
+    async def broadcast_stop_command(self, message):
+        if message.from_user.id not in ADMIN_IDS:
+            return
+        cancelled = 0
+        for name, monitor in self.servers.items():
+            try:
+                cancelled += await monitor.broadcasts.cancel()
+            except Exception as e:
+                logger.error(f"Error cancelling broadcasts of server {name}: {e}")
+        logger.info(f"Admin {message.from_user.id} cancelled {cancelled} broadcasts")
+        await self.bot.send_message(message.chat.id, f"⏹ Остановлено рассылок: {cancelled}")
     
     async def start_monitoring(self):
-        await self.init_monitor()
-        
-        asyncio.create_task(self.monitor_telegram_table())
-        asyncio.create_task(self.check_expired_codes())
+        self.supervisor.spawn('loop_lag', self.profiler.sample_lag)
+        self.profiler.start_watchdog()
+        self.sender.start()
+        for index, monitor in enumerate(self.servers.values()):
+            monitor.start(self.sender, self.supervisor, stagger=index * MONITOR_INTERVAL / len(self.servers))
         
-        logger.info("Мониторинг запущен")
+        logger.info(f"Мониторинг запущен (серверы: {', '.join(self.servers)})")
     
     async def run(self):
-        await self.db.initialize()
+        if METRICS_PORT:
+            await metrics.start()
+        await asyncio.gather(*(monitor.db.initialize() for monitor in self.servers.values()))
+        if MIGRATE_SCHEMA:
+            await asyncio.gather(*(monitor.db.create_unique_tg_id() for monitor in self.servers.values()))
         await self.start_monitoring()
+        
+        if not self.poll_updates:
+            logger.info("Бот запущен в режиме монитора (без получения обновлений)")
+            await asyncio.Event().wait()
+        
+        self.dispatcher.start()
+        
+        if self.webhook is not None:
+            await self.webhook.start()
+            logger.info("Бот запущен (webhook)")
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await self.webhook.stop()
+        
+        # Если раньше был установлен webhook, getUpdates вернет 409
+        await self.bot.delete_webhook()
         logger.info("Бот запущен")
-        await self.bot.infinity_polling()
+        await self.poll_updates_loop()
+    
+    async def shutdown(self, run_task: asyncio.Task, deadline: float = SHUTDOWN_DEADLINE):
+        # Порядок остановки: прием обновлений -> принятые обновления -> фоновые задачи
+        # мониторов -> очередь уведомлений и обнуление кодов; все в пределах deadline
+        until = time.monotonic() + deadline
+        remaining = lambda: max(until - time.monotonic(), 0.1)
+        logger.info(f"Остановка бота (не дольше {deadline:.0f} с)")
+        
+        run_task.cancel()
+        await asyncio.gather(run_task, return_exceptions=True)
+        
+        try:
+            await asyncio.wait_for(self.dispatcher.drain(), remaining())
+        except asyncio.TimeoutError:
+            logger.warning(f"Остановка: не обработано обновлений: {self.dispatcher.stats()['queued']}")
+        await self.dispatcher.stop()
+        
+        await self.supervisor.stop(timeout=remaining())
+        self.profiler.stop()
+        
+        results = await asyncio.gather(
+            self.sender.drain(remaining()),
+            *(monitor.flush_expirations(until) for monitor in self.servers.values()),
+            return_exceptions=True
+        )
+        unsent, expired = results[0], results[1:]
+        if isinstance(unsent, Exception) or unsent:
+            logger.warning(f"Остановка: не отправлено уведомлений: {unsent}")
+        for monitor, result in zip(self.servers.values(), expired):
+            if isinstance(result, Exception):
+                logger.error(f"[{monitor.server.name}] Остановка: не удалось обнулить коды: {result}")
+            elif result:
+                logger.info(f"[{monitor.server.name}] Остановка: обнулено кодов до истечения срока: {result}")
+        
+        logger.info("Бот остановлен")
+    
+    async def poll_updates_loop(self):
+        # Вместо infinity_polling: пачка getUpdates раскладывается по полосам
+        # диспетчера и не ждет завершения обработчиков перед следующим запросом
+        offset = None
+        
+        while True:
+            try:
+                updates = await self.bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT)
+            except Exception as e:
+                record_api_error('getUpdates', e)
+                logger.error(f"Polling error: {e}")
+                await asyncio.sleep(3)
+                continue
+            
+            for update in updates:
+                offset = update.update_id + 1
+                # Не ждет обработчиков: отбрасываются только лишние обновления
+                # пользователя, превысившего DISPATCH_USER_QUEUE
+                self.dispatcher.submit_nowait(update)
 
 async def main():
-    db_manager = DatabaseManager()
-    code_manager = CodeManager()
-    bot = TelegramBot('8313881273:AAF7OLED6eJK7ozhQ5tJL-kcIZE0cs-K-VU', db_manager, code_manager)
+    store = SQLiteStateStore(STATE_DB_PATH) if STATE_DB_PATH else MemoryStateStore()
+    code_manager = CodeManager(store)
+    monitors = []
+    for index, server in enumerate(load_servers()):
+        db_manager = DatabaseManager(server)
+        # Каждому потоку репликации нужен свой server_id
+        binlog_source = (BinlogEventSource(db_manager.db_config, BINLOG_SERVER_ID + index, server_name=server.name)
+                         if EVENT_SOURCE == 'binlog' else None)
+        shard_leases = ShardLeaseManager(db_manager) if SHARD_COUNT > 1 else None
+        monitors.append(ServerMonitor(db_manager, CodeManager(store, f"code:{server.name}"),
+                                      binlog_source, shard_leases))
+    bot = TelegramBot('8313881273:AAF7OLED6eJK7ozhQ5tJL-kcIZE0cs-K-VU', monitors, code_manager,
+                      POLL_UPDATES, UPDATE_MODE)
     
+    stop_requested = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_requested.set)
+    loop.add_signal_handler(signal.SIGUSR1, bot.profiler.dump_stacks)
+    loop.add_signal_handler(signal.SIGUSR2, bot.profiler.toggle_profile)
+    
+    run_task = asyncio.create_task(bot.run())
+    stop_task = asyncio.create_task(stop_requested.wait())
     try:
-        await bot.run()
-    except Exception as e:
-        logger.error(f"Bot crashed: {e}")
+        await asyncio.wait([run_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+        if run_task.done() and not run_task.cancelled() and run_task.exception() is not None:
+            logger.error(f"Bot crashed: {run_task.exception()}")
+        await bot.shutdown(run_task)
     finally:
-        if db_manager.pool:
-            db_manager.pool.close()
-            await db_manager.pool.wait_closed()
+        stop_task.cancel()
+        for monitor in monitors:
+            if monitor.shards is not None and monitor.db.pool:
+                try:
+                    await monitor.shards.release()
+                except Exception as e:
+                    logger.error(f"Failed to release shard leases of server {monitor.server.name}: {e}")
+            await monitor.db.close()
+        store.close()
+        await metrics.stop()
+        executors.shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    log_listener = setup_logging()
+    try:
+        asyncio.run(main())
+    finally:
+        log_listener.stop()
\ No newline at end of file